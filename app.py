@@ -1,176 +1,312 @@
 import gradio as gr
+import copy
 import json
+import os
 import torch
 import random
+import threading
+import uuid
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 from game import LoveLiveGame
-from model import LoveLiveTransformer
+from model import LoveLiveTransformer, SequenceBuffers, compile_for_inference, configure_cpu_threads, load_weights, lookup_tables
 
 # --- Game State Management ---
 
+NAMES_CACHE_PATH = 'sorted_names.json'
+SESSION_CACHE_SIZE = 256
+
+# Live LoveLiveGame objects keyed by session id (LRU). gr.State only carries
+# the id plus a compact snapshot used if the entry has been evicted.
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+
+game_instance = None
+
+def get_game_instance():
+    # game_data.json is parsed on first use, not at import
+    global game_instance
+    if game_instance is None:
+        game_instance = LoveLiveGame()
+    return game_instance
+
+def new_game():
+    # Static tables are shared with the parsed instance; start_game and
+    # deserialize_game reassign all per-game state on the copy.
+    game = copy.copy(get_game_instance())
+    game.session_lock = threading.Lock()
+    return game
+
+def load_dropdown_names(data_path='game_data.json', cache_path=NAMES_CACHE_PATH):
+    """
+    Returns the sorted song/artist/live names for the dropdowns.
+    Read from a JSON cache so a cold start doesn't have to build a LoveLiveGame;
+    the cache is rebuilt when missing or older than the game data.
+    """
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(data_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    game = get_game_instance()
+    names = {
+        'songs': sorted([s['name'] for s in game.songs.values()]),
+        'artists': sorted([a['name'] for a in game.artists.values()]),
+        'lives': sorted([l['name'] for l in game.lives.values()]),
+    }
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(names, f, ensure_ascii=False)
+    except OSError:
+        pass # Read-only filesystem; just skip caching
+    return names
+
 def init_game():
-    game = LoveLiveGame()
+    game = new_game()
     target_id = game.start_game()
     return serialize_game(game), f"Game Started! Guess the live concert."
 
 def serialize_game(game):
+    if not hasattr(game, 'session_id'):
+        game.session_id = uuid.uuid4().hex
+
+    with sessions_lock:
+        sessions[game.session_id] = game
+        sessions.move_to_end(game.session_id)
+        while len(sessions) > SESSION_CACHE_SIZE:
+            sessions.popitem(last=False)
+
     return {
+        'session_id': game.session_id,
         'target_live_id': game.target_live_id,
-        'possible_live_ids': list(game.possible_live_ids),
+        # Candidate set as int32 positions into game.live_ids
+        'possible_live_ids': np.fromiter((game.live_index[lid] for lid in game.possible_live_ids), dtype=np.int32).tobytes(),
         'guessed_song_ids': list(game.guessed_song_ids),
         'guessed_live_ids': list(game.guessed_live_ids),
         'history': game.history
     }
 
 def deserialize_game(state):
-    game = LoveLiveGame()
+    if state:
+        with sessions_lock:
+            game = sessions.get(state['session_id'])
+        if game is not None:
+            return game
+
+    game = new_game()
     if not state:
         game.start_game()
         return game
 
+    # Session was evicted: rebuild it from the snapshot
+    game.session_id = state['session_id']
     game.target_live_id = state['target_live_id']
     game.target_live = game.lives[game.target_live_id]
-    game.possible_live_ids = set(state['possible_live_ids'])
+    game.possible_live_ids = {game.live_ids[i] for i in np.frombuffer(state['possible_live_ids'], dtype=np.int32).tolist()}
     game.guessed_song_ids = set(state['guessed_song_ids'])
     game.guessed_live_ids = set(state['guessed_live_ids'])
-    game.history = state['history']
+    game.history = list(state['history'])
     return game
 
+@contextmanager
+def session_game(state):
+    """
+    Yields the session's game with its lock held. A cached game is shared by
+    every handler of that session, so concurrent events mustn't interleave
+    their reads and updates of its candidates/history.
+    """
+    game = deserialize_game(state)
+    with game.session_lock:
+        yield game
+
 # --- AI Model Loading ---
 
-try:
-    with open('mappings.json', 'r') as f:
-        ai_mappings = json.load(f)
-
-    # Init sizing from mappings (decoupled from game_data.json)
-    num_songs = len(ai_mappings['song_to_idx']) + 1
-    num_artists = len(ai_mappings['artist_to_idx']) + 1
-    num_feedback = 4
-    num_lives = len(ai_mappings['live_to_idx'])
-
-    device = torch.device('cpu') # Use CPU for HF Spaces inference usually
-    ai_model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(device)
-    if torch.cuda.is_available():
-        map_loc = torch.device('cuda')
-    else:
-        map_loc = torch.device('cpu')
-
-    ai_model.load_state_dict(torch.load('transformer_model.pth', map_location=map_loc))
-    ai_model.eval()
-    print("AI Model Loaded")
-except Exception as e:
-    print(f"AI Model Load Failed: {e}")
-    ai_model = None
-    ai_mappings = None
+def _rank(logits, mask, k):
+    # Softmax restricted to the allowed lives equals the old mask-and-renormalize
+    p = logits.masked_fill(~mask, float('-inf')).softmax(-1)
+    return p.topk(k)
+
+class AIPredictor:
+    """
+    The loaded model together with every immutable lookup it needs. One
+    instance serves all Gradio sessions for the lifetime of the process.
+    """
+    def __init__(self, mappings_path='mappings.json', model_path='transformer_model.pth'):
+        with open(mappings_path, 'r') as f:
+            mappings = json.load(f)
+        self.song_to_idx = mappings['song_to_idx']
+        self.artist_to_idx = mappings['artist_to_idx']
+        self.live_to_idx = mappings['live_to_idx']
+        # Input tokens are precomputed so history isn't offset per token
+        tables = lookup_tables(mappings)
+        self.song_inputs = tables['song_inputs']
+        self.artist_inputs = tables['artist_inputs']
+        self.idx_to_live = tables['idx_to_live']
+
+        # Init sizing from mappings (decoupled from game_data.json)
+        num_songs = len(self.song_to_idx) + 1
+        num_artists = len(self.artist_to_idx) + 1
+        num_feedback = 4
+        self.num_lives = len(self.live_to_idx)
+
+        self.device = torch.device('cpu') # Use CPU for HF Spaces inference usually
+        configure_cpu_threads()
+        model = LoveLiveTransformer(num_songs, num_artists, num_feedback, self.num_lives).to(self.device)
+        load_weights(model, model_path, self.device)
+        model.eval()
+
+        # History is bounded by the positional encoding length
+        self.input_buffers = SequenceBuffers(model.pos_encoder.pe.size(0), 1, self.device)
+        self.allowed_mask = torch.ones(self.num_lives, dtype=torch.bool, device=self.device)
+        # Game live row -> model live index (-1 if unknown), built for the first game seen
+        self._live_rows_to_idx = None
+        self._live_rows_for = None
+        # Buffers are shared, so one prediction runs at a time
+        self.lock = threading.Lock()
+
+        if os.environ.get('AI_QUANTIZE_INT8') == '1':
+            # int8 dynamic quantization of the Linear layers. Opt-in only: at this
+            # model size it is slower than FP32 on CPU and cannot be compiled.
+            self.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            self.model = compile_for_inference(model, self.device)
+
+        # Fuse masking, softmax and top-k into a single compiled kernel
+        try:
+            self.rank_fn = torch.compile(_rank)
+            self.rank_fn(torch.zeros(1, self.num_lives, device=self.device), self.allowed_mask, 5)
+        except Exception as e:
+            print(f"torch.compile failed for ranking ({e}). Using eager ranking.")
+            self.rank_fn = _rank
+
+    def _candidate_indices(self, game):
+        # Session games are copies of one template and share its live_ids list
+        if self._live_rows_for is not game.live_ids:
+            self._live_rows_to_idx = np.array([self.live_to_idx.get(lid, -1) for lid in game.live_ids], dtype=np.int64)
+            self._live_rows_for = game.live_ids
+        indices = self._live_rows_to_idx[game.candidate_rows()]
+        return torch.from_numpy(indices[indices >= 0]).to(self.device)
+
+    def predict(self, game, k=5):
+        """Returns the top k (live_id, probability) among the game's remaining candidates."""
+        with self.lock:
+            self.input_buffers.write_sequence(0, [(self.song_inputs[sid], self.artist_inputs[aid], fb + 1) for sid, aid, fb in game.history])
+            s_in, a_in, f_in = self.input_buffers.inputs(len(game.history))
+
+            # Apply mask (no possible lives falls back to the unmasked prediction)
+            possible_indices = self._candidate_indices(game)
+            if len(possible_indices):
+                self.allowed_mask.fill_(False)
+                self.allowed_mask[possible_indices] = True
+            else:
+                self.allowed_mask.fill_(True)
+
+            with torch.inference_mode():
+                logits = self.model(s_in, a_in, f_in)
+                top_k = self.rank_fn(logits, self.allowed_mask, k)
+
+            # Single device-to-host transfer for the whole result
+            top_probs, top_idxs = top_k.values.squeeze(0).tolist(), top_k.indices.squeeze(0).tolist()
+
+        return [(self.idx_to_live[idx], prob) for idx, prob in zip(top_idxs, top_probs)]
+
+ai_predictor = None
+
+def load_ai_model():
+    global ai_predictor
+    try:
+        ai_predictor = AIPredictor()
+        print("AI Model Loaded")
+    except Exception as e:
+        print(f"AI Model Load Failed: {e}")
+        ai_predictor = None
+
+# Load in the background so building the UI isn't blocked on reading and
+# compiling the model; get_ai_prediction waits for it on first use.
+ai_loader = threading.Thread(target=load_ai_model, daemon=True)
+ai_loader.start()
 
 # --- Logic Functions ---
 
 def guess_song(state, song_name, artist_name):
-    game = deserialize_game(state)
-
-    sid = game.find_song_id(song_name)
-    aid = game.find_artist_id(artist_name)
+    with session_game(state) as game:
+        sid = game.find_song_id(song_name)
+        aid = game.find_artist_id(artist_name)
 
-    if not sid:
-        return state, "Song not found.", format_history(game)
-    if not aid:
-        return state, "Artist not found.", format_history(game)
+        if not sid:
+            return state, "Song not found.", format_history(game)
+        if not aid:
+            return state, "Artist not found.", format_history(game)
 
-    if sid in game.guessed_song_ids:
-        return state, "Already guessed this song.", format_history(game)
+        if sid in game.guessed_song_ids:
+            return state, "Already guessed this song.", format_history(game)
 
-    feedback = game.guess_song(sid, aid)
-    game.prune_candidates(sid, aid, feedback)
+        feedback = game.guess_song(sid, aid)
+        game.prune_candidates(sid, aid, feedback)
 
-    msg = ""
-    if feedback == 2: msg = "PERFECT MATCH! (Song & Artist correct)"
-    elif feedback == 1: msg = "SONG CORRECT! (Artist incorrect)"
-    else: msg = "WRONG. (Song not in live)"
+        msg = ""
+        if feedback == 2: msg = "PERFECT MATCH! (Song & Artist correct)"
+        elif feedback == 1: msg = "SONG CORRECT! (Artist incorrect)"
+        else: msg = "WRONG. (Song not in live)"
 
-    msg += f"\nCandidates remaining: {len(game.possible_live_ids)}"
+        msg += f"\nCandidates remaining: {game.candidate_count()}"
 
-    return serialize_game(game), msg, format_history(game)
+        return serialize_game(game), msg, format_history(game)
 
 def guess_live(state, live_name):
-    game = deserialize_game(state)
-    lid = game.find_live_id(live_name)
+    with session_game(state) as game:
+        lid = game.find_live_id(live_name)
 
-    if not lid:
-        return state, "Live not found.", format_history(game)
+        if not lid:
+            return state, "Live not found.", format_history(game)
 
-    is_correct = game.guess_live(lid)
+        is_correct = game.guess_live(lid)
 
-    if is_correct:
-        msg = f"CONGRATULATIONS! You found the live: {game.lives[lid]['name']}"
-    else:
-        msg = "Incorrect Live."
-        if lid in game.possible_live_ids:
-            game.possible_live_ids.remove(lid)
-        msg += f"\nCandidates remaining: {len(game.possible_live_ids)}"
+        if is_correct:
+            msg = f"CONGRATULATIONS! You found the live: {game.lives[lid]['name']}"
+        else:
+            msg = "Incorrect Live."
+            game.remove_candidate(lid)
+            msg += f"\nCandidates remaining: {game.candidate_count()}"
 
-    return serialize_game(game), msg, format_history(game)
+        return serialize_game(game), msg, format_history(game)
 
 def get_entropy_hint(state):
-    game = deserialize_game(state)
-    moves = game.get_best_moves(top_k=5)
+    with session_game(state) as game:
+        moves = game.get_best_moves(top_k=5)
 
-    if not moves:
-        return "No moves available."
+        if not moves:
+            return "No moves available."
 
-    txt = "Top Entropy Suggestions:\n"
-    for sid, score in moves:
-        txt += f"- {game.songs[sid]['name']} (Score: {score:.4f})\n"
-    return txt
+        txt = "Top Entropy Suggestions:\n"
+        for sid, score in moves:
+            txt += f"- {game.songs[sid]['name']} (Score: {score:.4f})\n"
+        return txt
 
 def get_ai_prediction(state):
-    if not ai_model or not ai_mappings:
+    ai_loader.join()
+    if not ai_predictor:
         return "AI Model not available."
 
-    game = deserialize_game(state)
-    if not game.history:
-        return "Make at least one guess for AI prediction."
+    with session_game(state) as game:
+        if not game.history:
+            return "Make at least one guess for AI prediction."
 
-    song_to_idx = ai_mappings['song_to_idx']
-    artist_to_idx = ai_mappings['artist_to_idx']
-    idx_to_live = {v: k for k, v in ai_mappings['live_to_idx'].items()}
+        try:
+            predictions = ai_predictor.predict(game, k=5)
 
-    try:
-        songs_seq = [song_to_idx[h[0]] + 1 for h in game.history]
-        artists_seq = [artist_to_idx[h[1]] + 1 for h in game.history]
-        feedbacks_seq = [h[2] + 1 for h in game.history]
-
-        s_in = torch.tensor(songs_seq, device=device).unsqueeze(1)
-        a_in = torch.tensor(artists_seq, device=device).unsqueeze(1)
-        f_in = torch.tensor(feedbacks_seq, device=device).unsqueeze(1)
-
-        with torch.no_grad():
-            logits = ai_model(s_in, a_in, f_in)
-            probs = torch.softmax(logits, dim=1).squeeze(0)
-
-        # Apply mask
-        mask = torch.zeros_like(probs)
-        live_to_idx = ai_mappings['live_to_idx']
-        possible_indices = [live_to_idx[lid] for lid in game.possible_live_ids if lid in live_to_idx]
-
-        if possible_indices:
-            mask[possible_indices] = 1.0
-            probs = probs * mask
-            if probs.sum() > 0:
-                probs = probs / probs.sum()
-
-        top_k = torch.topk(probs, k=5)
-
-        txt = "AI Live Predictions:\n"
-        for i in range(len(top_k.indices)):
-            idx = top_k.indices[i].item()
-            prob = top_k.values[i].item()
-            if prob < 0.001: continue
-            lid = idx_to_live[idx]
-            txt += f"{i+1}. {game.lives[lid]['name']} ({prob:.1%})\n"
+            txt = "AI Live Predictions:\n"
+            for i, (lid, prob) in enumerate(predictions):
+                if prob < 0.001: continue
+                txt += f"{i+1}. {game.lives[lid]['name']} ({prob:.1%})\n"
 
-        return txt
+            return txt
 
-    except Exception as e:
-        return f"AI Error: {e}"
+        except Exception as e:
+            return f"AI Error: {e}"
 
 def format_history(game):
     txt = "History:\n"
@@ -186,10 +322,10 @@ def format_history(game):
 
 # --- UI Construction ---
 
-game_instance = LoveLiveGame()
-all_songs = sorted([s['name'] for s in game_instance.songs.values()])
-all_artists = sorted([a['name'] for a in game_instance.artists.values()])
-all_lives = sorted([l['name'] for l in game_instance.lives.values()])
+dropdown_names = load_dropdown_names()
+all_songs = dropdown_names['songs']
+all_artists = dropdown_names['artists']
+all_lives = dropdown_names['lives']
 
 with gr.Blocks(title="Love Live! Wordle AI") as demo:
     gr.Markdown("# Love Live! Setlist Guessing Game (AI Assisted)")
@@ -1,13 +1,18 @@
+import copy
 import json
+import os
 import torch
 import random
 import time
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from model import LoveLiveTransformer
+from model import LoveLiveTransformer, SequenceBuffers, compile_for_inference, compile_tensorrt, configure_cpu_threads, lookup_tables
 from game import LoveLiveGame
 
+MAX_TURNS = 20
+
 class Agent:
     def __init__(self, game):
         self.game = game
@@ -30,7 +35,7 @@ class PureAlgoAgent(Agent):
 
             # Strategy:
             # 1. Check if candidates == 1
-            if len(self.game.possible_live_ids) == 1:
+            if self.game.candidate_count() == 1:
                 guess_live_id = list(self.game.possible_live_ids)[0]
                 if self.game.guess_live(guess_live_id):
                     solved = True
@@ -44,11 +49,11 @@ class PureAlgoAgent(Agent):
                 sid = best_moves[0][0]
             else:
                 # Random fallback
-                sid = random.choice(list(self.game.songs.keys()))
+                sid = self.game.rng.choice(self.game.song_ids)
 
             # Pick artist (first available)
             aids = self.game.songs[sid]['artist_ids']
-            aid = aids[0] if aids else list(self.game.artists.keys())[0]
+            aid = aids[0] if aids else self.game.artist_ids[0]
 
             # Execute
             feedback = self.game.guess_song(sid, aid)
@@ -56,8 +61,39 @@ class PureAlgoAgent(Agent):
 
         return solved, turns
 
+def _top_live(logits, impossible):
+    # Pruning applied in log space; only the top entry's softmax probability is
+    # computed. Index and probability are stacked so the caller reads both back
+    # with a single device sync.
+    logits = logits.masked_fill(impossible, float('-inf'))
+    top_logits, top_idxs = logits.max(dim=1)
+    top_probs = torch.exp(top_logits - torch.logsumexp(logits, dim=1))
+    return torch.stack((top_idxs.to(logits.dtype), top_probs))
+
+def _seed_game(game, seed, game_index):
+    # Each game gets its own RNG stream derived from (seed, game_index), so
+    # results don't depend on which process plays it or in what order
+    if seed is not None:
+        game.rng.seed(f"{seed}:{game_index}")
+
+# One PureAlgoAgent per worker process, built by the pool initializer
+_worker_agent = None
+_worker_seed = None
+
+def _init_algo_worker(seed=None):
+    global _worker_agent, _worker_seed
+    _worker_agent = PureAlgoAgent(LoveLiveGame(seed=seed))
+    _worker_seed = seed
+
+def _play_algo(job):
+    game_index, lid = job
+    _seed_game(_worker_agent.game, _worker_seed, game_index)
+    start = time.time()
+    solved, turns = _worker_agent.play(lid)
+    return solved, turns, time.time() - start
+
 class HybridAIAgent(Agent):
-    def __init__(self, game, model_path='transformer_model.pth', mappings_path='mappings.json'):
+    def __init__(self, game, model_path='transformer_model.pth', mappings_path='mappings.json', batch_size=1):
         super().__init__(game)
 
         with open(mappings_path, 'r') as f:
@@ -65,7 +101,10 @@ class HybridAIAgent(Agent):
         self.song_to_idx = mappings['song_to_idx']
         self.artist_to_idx = mappings['artist_to_idx']
         self.live_to_idx = mappings['live_to_idx']
-        self.idx_to_live = {v: k for k, v in self.live_to_idx.items()}
+        tables = lookup_tables(mappings)
+        self.song_inputs = tables['song_inputs']
+        self.artist_inputs = tables['artist_inputs']
+        self.idx_to_live = tables['idx_to_live']
 
         num_songs = len(game.songs) + 1
         num_artists = len(game.artists) + 1
@@ -78,104 +117,187 @@ class HybridAIAgent(Agent):
             self.device = torch.device('mps')
         else:
             self.device = torch.device('cpu')
+            configure_cpu_threads()
 
         self.model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(self.device)
         self.model.load_state_dict(torch.load(model_path, map_location=self.device))
         self.model.eval()
 
-    def play(self, target_live_id):
-        self.game.start_game(target_live_id)
-        turns = 0
-        solved = False
-
-        songs_seq = []
-        artists_seq = []
-        feedbacks_seq = []
-        guessed_lives = set()
-
-        for _ in range(20):
-            turns += 1
-
-            # 1. AI Live Prediction
-            should_guess_live = False
-            guess_live_id = None
-
-            if len(songs_seq) > 0:
-                s_in = torch.tensor([x + 1 for x in songs_seq], device=self.device).unsqueeze(1)
-                a_in = torch.tensor([x + 1 for x in artists_seq], device=self.device).unsqueeze(1)
-                f_in = torch.tensor([x + 1 for x in feedbacks_seq], device=self.device).unsqueeze(1)
+        # On NVIDIA GPUs prefer a TensorRT engine. Its input shape is fixed, so
+        # sequences are always padded to MAX_TURNS and the batch is never
+        # narrowed to the active games. One engine per batch size: the one for
+        # batch_size (the number of games play_batch will be given) is built
+        # here, others on the first play_batch of that size.
+        self._static_seq_len = None
+        self._trt_engines = {}
+        trt_model = compile_tensorrt(self.model, self.device, MAX_TURNS, batch_size) if self.device.type == 'cuda' else None
+        if trt_model is not None:
+            self._eager_model = self.model
+            self._trt_engines[batch_size] = trt_model
+            self.model = trt_model
+            self._static_seq_len = MAX_TURNS
+        else:
+            # Batched play starts predicting at seq_len 1 with many games per batch
+            self.model = compile_for_inference(self.model, self.device, warmup_shapes=((1, 2), (2, 2)))
+
+        # Game live row -> model live index, so candidate masks are updated on
+        # the device without translating ids in Python
+        self.live_rows_to_idx = torch.tensor([self.live_to_idx[lid] for lid in game.live_ids], device=self.device)
+
+        # Input buffers, (re)allocated whenever the batch shape changes
+        self._buffers = None
+
+        # Post-model selection as one compiled (CUDA-graphed on GPU) subgraph
+        try:
+            mode = "reduce-overhead" if self.device.type == 'cuda' else None
+            self._top_live = torch.compile(_top_live, mode=mode, dynamic=True)
+            with torch.inference_mode():
+                for warm_batch in (1, 2):
+                    self._top_live(torch.zeros(warm_batch, num_lives, device=self.device),
+                                   torch.zeros(warm_batch, num_lives, dtype=torch.bool, device=self.device))
+        except Exception as e:
+            print(f"torch.compile failed for live selection ({e}). Using eager selection.")
+            self._top_live = _top_live
+
+    def _model_indices(self, rows):
+        return self.live_rows_to_idx[torch.from_numpy(rows).to(self.device, non_blocking=True)]
 
-                with torch.no_grad():
+    def play(self, target_live_id):
+        return self.play_batch([target_live_id])[0]
+
+    def play_batch(self, target_live_ids, max_turns=MAX_TURNS):
+        """
+        Plays one game per target live in lock-step, so each turn runs a single
+        batched forward pass over all still-active games instead of one per game.
+        Returns a list of (solved, turns) in the same order as target_live_ids.
+        """
+        # Static tables are shared; start_game gives each copy its own state.
+        games = []
+        for lid in target_live_ids:
+            g = copy.copy(self.game)
+            g.start_game(lid)
+            games.append(g)
+
+        num_games = len(games)
+        num_lives = len(self.live_to_idx)
+        turns = [0] * num_games
+        solved = [False] * num_games
+        active = [True] * num_games
+
+        buffer_len = max(max_turns, self._static_seq_len or 0)
+        if (self._buffers is None or self._buffers.max_len != buffer_len
+                or self._buffers.batch_size != num_games):
+            self._buffers = SequenceBuffers(buffer_len, num_games, self.device)
+        else:
+            self._buffers.reset()
+        if self._static_seq_len:
+            if num_games not in self._trt_engines:
+                # Falls back to the eager model for this batch size if the build fails
+                self._trt_engines[num_games] = (compile_tensorrt(self._eager_model, self.device, MAX_TURNS, num_games)
+                                                or self._eager_model)
+            self.model = self._trt_engines[num_games]
+        seq_lens = [0] * num_games
+        guessed_lives = [set() for _ in range(num_games)]
+
+        # Persistent per-game masks of ruled-out lives; candidates only ever
+        # shrink, so the game reports removals instead of the mask being rebuilt.
+        impossible_masks = torch.ones(num_games, num_lives, dtype=torch.bool, device=self.device)
+        for i, game in enumerate(games):
+            impossible_masks[i, self._model_indices(game.candidate_rows())] = False
+
+        def remove_lives(i, rows):
+            impossible_masks[i, self._model_indices(rows)] = True
+
+        for i, game in enumerate(games):
+            game.on_candidates_removed = lambda removed, i=i: remove_lives(i, removed)
+
+        for _ in range(max_turns):
+            playing = [i for i in range(num_games) if active[i]]
+            if not playing:
+                break
+
+            for i in playing:
+                turns[i] += 1
+
+            # 1. AI Live Prediction (one forward for the whole batch)
+            guess_live_ids = {}
+            # A single remaining candidate is guessed below regardless of the
+            # model, so those games skip the forward pass
+            batch = [i for i in playing if seq_lens[i] and games[i].candidate_count() > 1]
+            if batch:
+                # Every active game guesses once per turn, so lengths match; any
+                # shorter sequence is right-padded with 0, matching training.
+                max_len = max(seq_lens[i] for i in batch)
+                cols = torch.tensor(batch, device=self.device)
+
+                # (seq_len, batch_size) as the model expects. Gathered outside
+                # inference mode, like the compile warmup inputs, so the
+                # compiled model's guards match and it isn't recompiled.
+                if self._static_seq_len:
+                    s_in, a_in, f_in = self._buffers.inputs(self._static_seq_len)
+                else:
+                    s_in, a_in, f_in = self._buffers.inputs(max_len, cols)
+                with torch.inference_mode():
                     logits = self.model(s_in, a_in, f_in)
-                    probs = torch.softmax(logits, dim=1).squeeze(0)
+                    if self._static_seq_len:
+                        logits = logits.index_select(0, cols)
 
-                # Pruning mask
-                mask = torch.zeros_like(probs)
-                possible_indices = [self.live_to_idx[lid] for lid in self.game.possible_live_ids]
-                if possible_indices:
-                    mask[possible_indices] = 1.0
-                    probs = probs * mask
-                    if probs.sum() > 0:
-                        probs = probs / probs.sum()
+                    # (2, batch_size): top live index and its probability
+                    top_idxs, top_probs = self._top_live(logits, impossible_masks.index_select(0, cols)).tolist()
 
-                    top_idx = torch.argmax(probs).item()
-                    top_prob = probs[top_idx].item()
-                    top_lid = self.idx_to_live[top_idx]
+                for i, top_idx, top_prob in zip(batch, top_idxs, top_probs):
+                    top_lid = self.idx_to_live[int(top_idx)]
 
                     # Threshold for risking a guess
-                    if top_prob > 0.7 and top_lid not in guessed_lives:
-                        should_guess_live = True
-                        guess_live_id = top_lid
-
-            # Also check absolute certainty
-            if len(self.game.possible_live_ids) == 1:
-                should_guess_live = True
-                guess_live_id = list(self.game.possible_live_ids)[0]
-
-            if should_guess_live:
-                if self.game.guess_live(guess_live_id):
-                    solved = True
-                    break
+                    if top_prob > 0.7 and top_lid not in guessed_lives[i]:
+                        guess_live_ids[i] = top_lid
+
+            for i in playing:
+                game = games[i]
+
+                # Also check absolute certainty
+                if game.candidate_count() == 1:
+                    guess_live_ids[i] = list(game.possible_live_ids)[0]
+
+                if i in guess_live_ids:
+                    guess_live_id = guess_live_ids[i]
+                    if game.guess_live(guess_live_id):
+                        solved[i] = True
+                        active[i] = False
+                        continue
+                    else:
+                        guessed_lives[i].add(guess_live_id)
+                        game.remove_candidate(guess_live_id)
+
+                # 2. Pick Song (Entropy)
+                best_moves = game.get_best_moves(top_k=1)
+                if best_moves:
+                    sid = best_moves[0][0]
                 else:
-                    guessed_lives.add(guess_live_id)
-                    if guess_live_id in self.game.possible_live_ids:
-                        self.game.possible_live_ids.remove(guess_live_id)
+                    sid = game.rng.choice(game.song_ids)
 
-            # 2. Pick Song (Entropy)
-            best_moves = self.game.get_best_moves(top_k=1)
-            if best_moves:
-                sid = best_moves[0][0]
-            else:
-                sid = random.choice(list(self.game.songs.keys()))
+                aids = game.songs[sid]['artist_ids']
+                aid = aids[0] if aids else game.artist_ids[0]
 
-            aids = self.game.songs[sid]['artist_ids']
-            aid = aids[0] if aids else list(self.game.artists.keys())[0]
+                feedback = game.guess_song(sid, aid)
+                game.prune_candidates(sid, aid, feedback)
 
-            feedback = self.game.guess_song(sid, aid)
-            self.game.prune_candidates(sid, aid, feedback)
+                self._buffers.write(seq_lens[i], i, self.song_inputs[sid], self.artist_inputs[aid], feedback + 1)
+                seq_lens[i] += 1
 
-            songs_seq.append(self.song_to_idx[sid])
-            artists_seq.append(self.artist_to_idx[aid])
-            feedbacks_seq.append(feedback)
-
-        return solved, turns
+        return list(zip(solved, turns))
 
 def run_benchmark():
     parser = argparse.ArgumentParser(description="Benchmark LoveLive! Agents")
     parser.add_argument('--all', action='store_true', help='Run benchmark on ALL lives')
     parser.add_argument('--games', type=int, default=50, help='Number of games to run if not --all')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for reproducible runs')
     args = parser.parse_args()
 
-    game = LoveLiveGame()
+    if args.seed is not None:
+        random.seed(args.seed)
 
-    # Initialize agents
-    algo_agent = PureAlgoAgent(game)
-    try:
-        ai_agent = HybridAIAgent(game)
-        has_ai = True
-    except Exception as e:
-        print(f"Could not load AI Agent: {e}")
-        has_ai = False
+    game = LoveLiveGame(seed=args.seed)
 
     # Test Setup
     if args.all:
@@ -185,6 +307,16 @@ def run_benchmark():
         num_games = args.games
         test_live_ids = random.sample(game.live_ids, num_games)
 
+    # Initialize agents; the AI plays all games as one batch, so any
+    # fixed-shape engine is built for that batch size up front
+    algo_agent = PureAlgoAgent(game)
+    try:
+        ai_agent = HybridAIAgent(game, batch_size=num_games)
+        has_ai = True
+    except Exception as e:
+        print(f"Could not load AI Agent: {e}")
+        has_ai = False
+
     print(f"Starting Benchmark: {num_games} games")
     print("-" * 60)
     print(f"{'Agent':<15} | {'Avg Turns':<10} | {'Win Rate':<10} | {'Avg Time (s)':<12}")
@@ -195,12 +327,23 @@ def run_benchmark():
     total_time = 0
     wins = 0
 
-    for lid in tqdm(test_live_ids, desc="Running Pure Algo"):
-        start = time.time()
-        solved, turns = algo_agent.play(lid)
-        end = time.time()
+    workers = os.cpu_count() or 1
+    if workers > 1:
+        # Pure Python and CPU bound, so spread games over processes
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_algo_worker,
+                                 initargs=(args.seed,)) as pool:
+            results = list(tqdm(pool.map(_play_algo, enumerate(test_live_ids), chunksize=max(1, num_games // (workers * 4))),
+                                total=num_games, desc="Running Pure Algo"))
+    else:
+        results = []
+        for game_index, lid in enumerate(tqdm(test_live_ids, desc="Running Pure Algo")):
+            _seed_game(algo_agent.game, args.seed, game_index)
+            start = time.time()
+            solved, turns = algo_agent.play(lid)
+            results.append((solved, turns, time.time() - start))
 
-        total_time += (end - start)
+    for solved, turns, elapsed in results:
+        total_time += elapsed
         total_turns += turns
         if solved: wins += 1
 
@@ -212,18 +355,27 @@ def run_benchmark():
         total_time = 0
         wins = 0
 
-        for lid in tqdm(test_live_ids, desc="Running AI Hybrid"):
-            start = time.time()
-            solved, turns = ai_agent.play(lid)
-            end = time.time()
+        print("Running AI Hybrid (batched)...")
+        # One untimed batch of the same shape first, so compilation for it
+        # isn't counted. The RNG is restored so the timed games are unaffected.
+        rng_state = game.rng.getstate()
+        ai_agent.play_batch(test_live_ids)
+        game.rng.setstate(rng_state)
+
+        start = time.time()
+        results = ai_agent.play_batch(test_live_ids)
+        end = time.time()
 
-            total_time += (end - start)
+        total_time = end - start
+        for solved, turns in results:
             total_turns += turns
             if solved: wins += 1
 
-        print(f"{'AI Hybrid':<15} | {total_turns/num_games:<10.2f} | {wins/num_games:<10.0%} | {total_time/num_games:<12.4f}")
+        print(f"{'AI Hybrid*':<15} | {total_turns/num_games:<10.2f} | {wins/num_games:<10.0%} | {total_time/num_games:<12.4f}")
 
     print("-" * 60)
+    if has_ai:
+        print("* Amortised: wall time of one batch of all games / games. Pure Algo is per-game latency.")
 
 if __name__ == "__main__":
     run_benchmark()
@@ -1,22 +1,59 @@
 import json
 import torch
-import random
 import numpy as np
-from model import LoveLiveTransformer
+from model import LoveLiveTransformer, SequenceBuffers, capture_cuda_graphs, compile_for_inference, configure_cpu_threads, lookup_tables
 from game import LoveLiveGame
 
+# Entropy-ranked songs re-scored by model lookahead each turn (0 disables)
+LOOKAHEAD_SONGS = 16
+# At or below this many candidates pure entropy picks the song without lookahead
+CHEAP_THRESHOLD = 3
+
+def lookahead_song(model, game, buffers, seq_len, posterior, moves, song_inputs, artist_inputs, model_indices):
+    """
+    Re-ranks the (song_id, artist_id) shortlist by the model's expected posterior
+    entropy after each guess. Every song x feedback what-if sequence is scored
+    in a single batched forward; returns the index of the best move.
+    """
+    device = posterior.device
+    num_outcomes = 3 # feedback 0 / 1 / 2
+    batch = len(moves) * num_outcomes
+
+    # History tiled across the batch plus one hypothetical turn
+    hist = torch.stack(buffers.inputs(seq_len)) # (3, seq_len, 1)
+    inputs = torch.empty(3, seq_len + 1, batch, dtype=torch.long, device=device)
+    inputs[:, :seq_len] = hist
+    inputs[0, seq_len] = torch.tensor([song_inputs[sid] for sid, _ in moves], device=device).repeat_interleave(num_outcomes)
+    inputs[1, seq_len] = torch.tensor([artist_inputs[aid] for _, aid in moves], device=device).repeat_interleave(num_outcomes)
+    inputs[2, seq_len] = torch.arange(1, num_outcomes + 1, device=device).repeat(len(moves))
+
+    # Lives consistent with each outcome, under the same rules as prune_candidates
+    allowed = torch.zeros(batch, posterior.size(0), dtype=torch.bool, device=device)
+    for j, (sid, aid) in enumerate(moves):
+        has_song = game.song_to_lives_mask.get(sid, 0)
+        has_artist = game.artist_to_lives_mask.get(aid, 0)
+        for o, keep in enumerate((~has_song, has_song & ~has_artist, has_song & has_artist)):
+            allowed[j * num_outcomes + o, model_indices(game.mask_rows(game.possible_mask & keep))] = True
+
+    with torch.inference_mode():
+        p_outcome = (posterior.unsqueeze(0) * allowed).sum(dim=1)
+        logits = model(inputs[0], inputs[1], inputs[2]).masked_fill(~allowed, float('-inf'))
+        entropy = torch.special.entr(torch.softmax(logits, dim=1)).sum(dim=1).nan_to_num(0.0)
+        expected = (p_outcome * entropy).view(len(moves), num_outcomes).sum(dim=1)
+
+    return int(expected.argmin())
+
 def evaluate():
     print("Loading resources...")
     with open('mappings.json', 'r') as f:
         mappings = json.load(f)
 
-    song_to_idx = mappings['song_to_idx']
-    artist_to_idx = mappings['artist_to_idx']
     live_to_idx = mappings['live_to_idx']
 
-    idx_to_live = {v: k for k, v in live_to_idx.items()}
-    idx_to_song = {v: k for k, v in song_to_idx.items()}
-    idx_to_artist = {v: k for k, v in artist_to_idx.items()}
+    tables = lookup_tables(mappings)
+    song_inputs = tables['song_inputs']
+    artist_inputs = tables['artist_inputs']
+    idx_to_live = tables['idx_to_live']
 
     game = LoveLiveGame()
 
@@ -32,24 +69,51 @@ def evaluate():
         device = torch.device('mps')
     else:
         device = torch.device('cpu')
+        configure_cpu_threads()
     model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(device)
     model.load_state_dict(torch.load('transformer_model.pth', map_location=device))
     model.eval()
 
+    max_turns = 20
+
+    # On CUDA replay one captured graph per sequence length; each turn is
+    # launch-bound at this model size. Graphs are batch-1, so lookahead
+    # batches run on the plain model.
+    graphed = capture_cuda_graphs(model, device, max_turns)
+    if graphed is not None:
+        lookahead_model, model = model, graphed
+    else:
+        model = lookahead_model = compile_for_inference(model, device)
+
     # Start a simulation
     target_id = game.start_game()
     print(f"Target Live: {game.lives[target_id]['name']}")
 
-    songs_seq = []
-    artists_seq = []
-    feedbacks_seq = []
 
     guessed_lives = set()
 
-    max_turns = 20
+    # Persistent mask of ruled-out lives; candidates only ever shrink, so the
+    # game reports removals instead of the mask being rebuilt every turn.
+    # Game live row -> model live index, so updates never translate ids in Python
+    live_rows_to_idx = torch.tensor([live_to_idx[lid] for lid in game.live_ids], device=device)
+
+    def model_indices(rows):
+        return live_rows_to_idx[torch.from_numpy(rows).to(device, non_blocking=True)]
+
+    impossible_mask = torch.ones(num_lives, dtype=torch.bool, device=device)
+    impossible_mask[model_indices(game.candidate_rows())] = False
+
+    def remove_lives(rows):
+        impossible_mask[model_indices(rows)] = True
+
+    game.on_candidates_removed = remove_lives
+
     solved = False
 
-    all_song_ids = list(game.songs.keys())
+    # Static (max_turns, 1) input buffers written in place each turn
+    buffers = SequenceBuffers(max_turns, 1, device)
+    seq_len = 0
+
 
     for turn in range(max_turns):
         # Prepare input
@@ -57,62 +121,56 @@ def evaluate():
         # Model expects (seq_len, batch_size)
         # We can pass current length seq.
 
-        if len(songs_seq) == 0:
+        if seq_len == 0:
             # First turn: random guess or empty input?
             # Model trained on seq_len >= 1.
             # So first guess random.
             # Ideally "optimal" would mean picking a song that splits the space well initially.
             # Let's pick a very common song or just random.
             # Random for diversity.
-            guess_song_id = random.choice(all_song_ids)
+            guess_song_id = game.rng.choice(game.song_ids)
             # Pick an artist for this song
             artist_candidates = game.songs[guess_song_id]['artist_ids']
-            guess_artist_id = random.choice(artist_candidates) if artist_candidates else random.choice(list(game.artists.keys()))
+            guess_artist_id = game.rng.choice(artist_candidates) if artist_candidates else game.rng.choice(game.artist_ids)
 
             print(f"Turn {turn+1}: First guess random -> {game.songs[guess_song_id]['name']}")
         else:
-            # Use model to predict live
-            # Map indices + 1
-            s_in = torch.tensor([x + 1 for x in songs_seq], device=device).unsqueeze(1) # (seq_len, 1)
-            a_in = torch.tensor([x + 1 for x in artists_seq], device=device).unsqueeze(1)
-            f_in = torch.tensor([x + 1 for x in feedbacks_seq], device=device).unsqueeze(1)
-
-            with torch.no_grad():
-                logits = model(s_in, a_in, f_in)
-                probs = torch.softmax(logits, dim=1).squeeze(0) # (num_lives)
-
-            # Check if model's top choice is invalid (pruned)
-            raw_top_idx = torch.argmax(probs).item()
-            raw_top_live_id = idx_to_live[raw_top_idx]
-            if raw_top_live_id not in game.possible_live_ids:
-                 print(f"  [Model Warning] Model wanted to pick {game.lives[raw_top_live_id]['name']} but it is pruned.")
-
             # Apply hard constraints (pruning)
             # Mask out impossible lives based on game.possible_live_ids
-            mask = torch.zeros_like(probs)
-            possible_indices = [live_to_idx[lid] for lid in game.possible_live_ids]
-
-            if not possible_indices:
+            if not game.possible_mask:
                 print("Error: No possible lives remaining according to hard constraints!")
                 break
 
-            mask[possible_indices] = 1.0
-            probs = probs * mask
-            if probs.sum() == 0:
-                 # Fallback (shouldn't happen if logic correct)
-                 probs[possible_indices] = 1.0
-            probs = probs / (probs.sum() + 1e-9)
+            logits = None
+            if game.candidate_count() == 1:
+                # The masked prediction is certain, so skip the model forward
+                top_live_id = next(iter(game.possible_live_ids))
+                top_prob = 1.0
+            else:
+                # Use model to predict live
+                s_in, a_in, f_in = buffers.inputs(seq_len) # (seq_len, 1)
+
+                with torch.inference_mode():
+                    logits = model(s_in, a_in, f_in).squeeze(0) # (num_lives)
+                    raw_top_idx = torch.argmax(logits)
+
+                    # Mask in log space; only the top entry's softmax probability is needed
+                    logits = logits.masked_fill_(impossible_mask, float('-inf'))
+                    top_logit, top_idx = torch.topk(logits, 1)
+                    top_prob = torch.exp(top_logit - torch.logsumexp(logits, dim=0))
 
-            # Sort predictions
-            sorted_indices = torch.argsort(probs, descending=True)
+                # Raw and masked picks come back in one transfer
+                raw_top_idx, top_idx, top_prob = torch.cat((raw_top_idx.to(logits.dtype).view(1), top_idx.to(logits.dtype), top_prob)).tolist()
+                top_live_id = idx_to_live[int(top_idx)]
 
-            top_idx = sorted_indices[0]
-            top_live_id = idx_to_live[top_idx.item()]
-            top_prob = probs[top_idx]
+                # Check if model's top choice is invalid (pruned)
+                raw_top_live_id = idx_to_live[int(raw_top_idx)]
+                if raw_top_live_id not in game.possible_live_ids:
+                     print(f"  [Model Warning] Model wanted to pick {game.lives[raw_top_live_id]['name']} but it is pruned.")
 
-            print(f"Turn {turn+1}: Top Prediction: {game.lives[top_live_id]['name']} ({top_prob.item():.4f}) [Candidates: {len(possible_indices)}]")
+            print(f"Turn {turn+1}: Top Prediction: {game.lives[top_live_id]['name']} ({top_prob:.4f}) [Candidates: {game.candidate_count()}]")
 
-            if top_prob.item() > 0.7 and top_live_id not in guessed_lives:
+            if top_prob > 0.7 and top_live_id not in guessed_lives:
                 # Try guessing the live
                 print(">> Guessing LIVE!")
                 if game.guess_live(top_live_id):
@@ -122,8 +180,7 @@ def evaluate():
                 else:
                     print("WRONG Live guess. Continuing...")
                     guessed_lives.add(top_live_id)
-                    if top_live_id in game.possible_live_ids:
-                        game.possible_live_ids.remove(top_live_id)
+                    game.remove_candidate(top_live_id)
 
             # Choose next song: Use Game Engine's Best Move (Entropy)
             # The game engine uses uniform probability over remaining candidates.
@@ -134,19 +191,34 @@ def evaluate():
 
             # Let's use the game engine's pure entropy for robustness, as the model
             # can be overconfident or biased. Pure entropy ensures we cut the search space.
+            # Option C: shortlist by pure entropy, then re-rank the shortlist by the
+            # model's expected posterior entropy (one batched forward).
 
-            best_moves = game.get_best_moves(top_k=1)
+            best_moves = game.get_best_moves(top_k=max(1, LOOKAHEAD_SONGS))
 
             if best_moves:
-                guess_song_id = best_moves[0][0]
-                print(f"Guessing Song: {game.songs[guess_song_id]['name']} (Score: {best_moves[0][1]:.4f})")
+                # Pick likely artist for each song
+                moves = []
+                for sid, _ in best_moves:
+                    a_ids = game.songs[sid]['artist_ids']
+                    moves.append((sid, a_ids[0] if a_ids else game.artist_ids[0]))
+
+                pick = 0
+                if logits is not None and len(moves) > 1 and game.candidate_count() > CHEAP_THRESHOLD:
+                    with torch.inference_mode():
+                        posterior = torch.softmax(logits.masked_fill_(impossible_mask, float('-inf')), dim=0)
+                    pick = lookahead_song(lookahead_model, game, buffers, seq_len, posterior, moves,
+                                          song_inputs, artist_inputs, model_indices)
+
+                guess_song_id, guess_artist_id = moves[pick]
+                print(f"Guessing Song: {game.songs[guess_song_id]['name']} (Score: {best_moves[pick][1]:.4f})")
             else:
                 # Fallback if no moves (shouldn't happen if candidates > 1)
-                guess_song_id = random.choice(all_song_ids)
+                guess_song_id = game.rng.choice(game.song_ids)
                 print(f"Guessing Song: {game.songs[guess_song_id]['name']} (Random Fallback)")
-            # Pick likely artist for this song
-            a_ids = game.songs[guess_song_id]['artist_ids']
-            guess_artist_id = a_ids[0] if a_ids else list(game.artists.keys())[0]
+                # Pick likely artist for this song
+                a_ids = game.songs[guess_song_id]['artist_ids']
+                guess_artist_id = a_ids[0] if a_ids else game.artist_ids[0]
 
         # Execute guess
         feedback = game.guess_song(guess_song_id, guess_artist_id)
@@ -155,9 +227,8 @@ def evaluate():
         # Prune candidates based on feedback
         game.prune_candidates(guess_song_id, guess_artist_id, feedback)
 
-        songs_seq.append(song_to_idx[guess_song_id])
-        artists_seq.append(artist_to_idx[guess_artist_id])
-        feedbacks_seq.append(feedback)
+        buffers.write(seq_len, 0, song_inputs[guess_song_id], artist_inputs[guess_artist_id], feedback + 1)
+        seq_len += 1
 
     if not solved:
         print("Failed to solve in max turns.")
@@ -1,13 +1,169 @@
 import json
+import os
 import random
 import difflib
 import math
+import numpy as np
 from collections import Counter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from rapidfuzz import fuzz, process, utils as fuzz_utils
+except ImportError:
+    process = None
+
+# Numba takes ~0.25s to import, more than it saves on this data size unless
+# get_best_moves runs many thousands of times, so it is opt-in.
+njit = None
+if os.environ.get('GAME_USE_NUMBA') == '1':
+    try:
+        from numba import njit
+    except ImportError:
+        pass
+
+# Bound once at module scope for calculate_entropy
+_log2 = math.log2
+
+# Upper bound on memoized fuzzy lookups before the cache is reset
+FUZZY_CACHE_SIZE = 1024
+
+# Static lookup tables derived from game_data.json, stored next to it as .npy
+INDEX_DIR = 'game_index'
+INDEX_ARRAYS = ('song_ids', 'artist_ids', 'live_ids',
+                'lives_songs', 'lives_songs_indptr', 'songs_artists', 'songs_artists_indptr',
+                'song_bits', 'artist_bits')
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount_rows(bits):
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int64)
+else:
+    # NumPy < 2.0 has no popcount ufunc; count bits over the byte view instead
+    def _popcount_rows(bits):
+        return np.unpackbits(bits.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+
+def _entropy_scores_numpy(counts, rows, total):
+    p_yes = counts[rows] / total
+    p_no = (total - counts[rows]) / total
+    scores = np.zeros(len(rows))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores -= np.where(p_yes > 0, p_yes * np.log2(p_yes), 0.0)
+        scores -= np.where(p_no > 0, p_no * np.log2(p_no), 0.0)
+    return scores
+
+def _entropy_scores_loop(counts, rows, total):
+    scores = np.zeros(len(rows))
+    for i in range(len(rows)):
+        yes = counts[rows[i]]
+        p_yes = yes / total
+        p_no = (total - yes) / total
+        if p_yes > 0:
+            scores[i] -= p_yes * math.log2(p_yes)
+        if p_no > 0:
+            scores[i] -= p_no * math.log2(p_no)
+    return scores
+
+# Binary entropy of each relevant song given its yes-count. With Numba the
+# loop is compiled into a single pass; otherwise NumPy evaluates it in a
+# few array passes.
+_entropy_scores = njit(cache=True)(_entropy_scores_loop) if njit is not None else _entropy_scores_numpy
+
+def _csr(rows, index):
+    """Packs lists of ids into int32 CSR (indices, indptr) over row numbers."""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int32)
+    indices = []
+    for i, ids in enumerate(rows):
+        cols = [index[x] for x in dict.fromkeys(ids) if x in index]
+        indices.extend(cols)
+        indptr[i + 1] = indptr[i] + len(cols)
+    return np.array(indices, dtype=np.int32), indptr
+
+def _bit_matrix(indices, indptr, num_cols):
+    """
+    Transposes CSR rows into packed bitsets: bit r of row c (little-endian
+    uint64 words) is set iff column c appears in CSR row r.
+    """
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    bits = np.zeros((num_cols, (len(indptr) - 1 + 63) // 64), dtype='<u8')
+    np.bitwise_or.at(bits, (indices, rows >> 6), np.left_shift(1, rows & 63).astype('<u8'))
+    return bits
+
+def _fold_name(name):
+    return name.casefold().strip()
+
+def load_game_data(data_path='game_data.json'):
+    with open(data_path, 'rb') as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def build_index_arrays(data):
+    """
+    Builds the CSR tables live row -> song rows and song row -> artist rows.
+    Row numbers follow the key order of the songs / artists / lives dicts.
+    """
+    song_ids, artist_ids, live_ids = list(data['songs']), list(data['artists']), list(data['lives'])
+    song_index = {sid: i for i, sid in enumerate(song_ids)}
+    artist_index = {aid: i for i, aid in enumerate(artist_ids)}
+
+    lives_songs, lives_songs_indptr = _csr([data['lives'][lid]['song_ids'] for lid in live_ids], song_index)
+    songs_artists, songs_artists_indptr = _csr([data['songs'][sid]['artist_ids'] for sid in song_ids], artist_index)
+    lives_artists, lives_artists_indptr = _csr([data['lives'][lid]['artist_ids'] for lid in live_ids], artist_index)
+
+    return {
+        'song_ids': np.array(song_ids, dtype=str),
+        'artist_ids': np.array(artist_ids, dtype=str),
+        'live_ids': np.array(live_ids, dtype=str),
+        'lives_songs': lives_songs,
+        'lives_songs_indptr': lives_songs_indptr,
+        'songs_artists': songs_artists,
+        'songs_artists_indptr': songs_artists_indptr,
+        # Song / artist -> lives membership bitsets over live rows
+        'song_bits': _bit_matrix(lives_songs, lives_songs_indptr, len(song_ids)),
+        'artist_bits': _bit_matrix(lives_artists, lives_artists_indptr, len(artist_ids)),
+    }
+
+def save_index_arrays(arrays, data_path='game_data.json'):
+    index_dir = os.path.join(os.path.dirname(data_path), INDEX_DIR)
+    os.makedirs(index_dir, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        path = os.path.join(index_dir, f'{name}.npy')
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arrays[name])
+        os.replace(tmp_path, path)
+
+def load_index_arrays(data, data_path='game_data.json'):
+    """
+    Memory-maps the cached tables when they are newer than data_path, so worker
+    processes share their pages; otherwise rebuilds and re-caches them.
+    """
+    index_dir = os.path.join(os.path.dirname(data_path), INDEX_DIR)
+    try:
+        data_mtime = os.path.getmtime(data_path)
+        paths = {name: os.path.join(index_dir, f'{name}.npy') for name in INDEX_ARRAYS}
+        if all(os.path.getmtime(p) >= data_mtime for p in paths.values()):
+            arrays = {name: np.load(p, mmap_mode='r') for name, p in paths.items()}
+            if (arrays['song_ids'].tolist() == list(data['songs'])
+                    and arrays['artist_ids'].tolist() == list(data['artists'])
+                    and arrays['live_ids'].tolist() == list(data['lives'])):
+                return arrays
+    except (OSError, ValueError):
+        pass
+
+    arrays = build_index_arrays(data)
+    try:
+        save_index_arrays(arrays, data_path)
+    except OSError:
+        pass
+    return arrays
+
 class LoveLiveGame:
-    def __init__(self, data_path='game_data.json'):
-        with open(data_path, 'r', encoding='utf-8') as f:
-            self.data = json.load(f)
+    def __init__(self, data_path='game_data.json', seed=None):
+        self.data = load_game_data(data_path)
 
         self.lives = self.data['lives']
         self.songs = self.data['songs']
@@ -15,18 +171,45 @@ class LoveLiveGame:
 
         # Pre-compute sets for O(1) lookups
         for live in self.lives.values():
-            live['song_ids_set'] = set(live['song_ids'])
-            live['artist_ids_set'] = set(live['artist_ids'])
+            live['song_ids_set'] = frozenset(live['song_ids'])
+            live['artist_ids_set'] = frozenset(live['artist_ids'])
+        for song in self.songs.values():
+            song['artist_ids_set'] = frozenset(song['artist_ids'])
 
         self.live_ids = list(self.lives.keys())
         self.song_ids = list(self.songs.keys())
         self.artist_ids = list(self.artists.keys())
 
+        # Dedicated generator, so runs can be reproduced by passing a seed
+        self.rng = random.Random(seed)
+        self.live_index = {lid: i for i, lid in enumerate(self.live_ids)}
+        self.song_index = {sid: i for i, sid in enumerate(self.song_ids)}
+
+        # CSR tables: songs of live row r are lives_songs[lives_songs_indptr[r]:lives_songs_indptr[r + 1]]
+        arrays = load_index_arrays(self.data, data_path)
+        self.lives_songs = arrays['lives_songs']
+        self.lives_songs_indptr = arrays['lives_songs_indptr']
+        self.songs_artists = arrays['songs_artists']
+        self.songs_artists_indptr = arrays['songs_artists_indptr']
+
+        # Membership bitsets over live rows: bit live_index[lid] is set iff
+        # the live contains the song / artist. The packed (rows, words) uint64
+        # matrices come from the index cache; song_bits also lets every song's
+        # yes-count be one vectorized AND + popcount.
+        self._bit_words = (len(self.live_ids) + 63) // 64
+        self.song_bits = arrays['song_bits']
+        self.song_to_lives_mask = {sid: int.from_bytes(row.tobytes(), 'little')
+                                   for sid, row in zip(self.song_ids, self.song_bits)}
+        self.artist_to_lives_mask = {aid: int.from_bytes(row.tobytes(), 'little')
+                                     for aid, row in zip(self.artist_ids, arrays['artist_bits'])}
+        self.all_lives_mask = (1 << len(self.live_ids)) - 1
+        self._all_song_counts = _popcount_rows(self.song_bits)
+
         self.target_live_id = None
         self.target_live = None
 
         # Candidates & History (Initialized here for safety, reset in start_game)
-        self.possible_live_ids = set(self.live_ids)
+        self._reset_candidates()
         self.guessed_song_ids = set()
         self.guessed_live_ids = set()
         self.history = [] # List of (song_id, artist_id, feedback)
@@ -35,22 +218,90 @@ class LoveLiveGame:
         self.song_name_map = {s['name']: sid for sid, s in self.songs.items()}
         self.artist_name_map = {a['name']: aid for aid, a in self.artists.items()}
         self.live_name_map = {l['name']: lid for lid, l in self.lives.items()}
+        # Case/whitespace-insensitive exact matches, checked before any fuzzy search
+        # (built in reverse so the first of colliding names wins)
+        self._folded_name_maps = {
+            id(name_map): {_fold_name(n): i for n, i in reversed(name_map.items())}
+            for name_map in (self.song_name_map, self.artist_name_map, self.live_name_map)
+        }
+
+        # Fuzzy matches are expensive and the same names are looked up repeatedly
+        self._fuzzy_cache = {}
+        # Per name map: (names, normalized names) for RapidFuzz, built on first use
+        self._fuzzy_choices = {}
+
+        # Optional callback(removed_rows), called whenever candidates are ruled out
+        # with a numpy array of their live rows (positions in live_ids)
+        self.on_candidates_removed = None
 
     def start_game(self, target_id=None):
         if target_id and target_id in self.lives:
             self.target_live_id = target_id
         else:
-            self.target_live_id = random.choice(self.live_ids)
+            self.target_live_id = self.rng.choice(self.live_ids)
         self.target_live = self.lives[self.target_live_id]
 
         # Reset state
-        self.possible_live_ids = set(self.live_ids)
+        self._reset_candidates()
         self.guessed_song_ids = set()
         self.guessed_live_ids = set()
         self.history = []
 
         return self.target_live_id
 
+    @property
+    def possible_live_ids(self):
+        """Remaining candidate lives as a frozenset, rebuilt only when the bitset changes."""
+        if self.__dict__.get('_possible_ids_mask') != self.possible_mask:
+            self._possible_ids = frozenset(self._mask_to_ids(self.possible_mask))
+            self._possible_ids_mask = self.possible_mask
+        return self._possible_ids
+
+    @possible_live_ids.setter
+    def possible_live_ids(self, live_ids):
+        mask = 0
+        for lid in live_ids:
+            mask |= 1 << self.live_index[lid]
+        self._reset_candidates(mask)
+
+    def _reset_candidates(self, mask=None):
+        """
+        Sets the candidate bitset and recounts song_counts, the number of
+        candidate lives containing each song. Removals update it incrementally.
+        """
+        if mask is None:
+            self.possible_mask = self.all_lives_mask
+            self.song_counts = self._all_song_counts.copy()
+        else:
+            self.possible_mask = mask
+            self.song_counts = _popcount_rows(self.song_bits & self._mask_words(mask))
+
+    def candidate_count(self):
+        """Number of remaining candidate lives, without decoding the bitset."""
+        return self.possible_mask.bit_count()
+
+    def _mask_bytes(self, mask):
+        return mask.to_bytes(self._bit_words * 8, 'little')
+
+    def _mask_words(self, mask):
+        return np.frombuffer(self._mask_bytes(mask), dtype='<u8')
+
+    def mask_rows(self, mask):
+        """Live rows (positions in live_ids) of the bits set in a live bitset, as a numpy array."""
+        return np.flatnonzero(np.unpackbits(self._mask_words(mask).view(np.uint8), bitorder='little'))
+
+    def candidate_rows(self):
+        """Live rows (positions in live_ids) of the remaining candidates, as a numpy array."""
+        return self.mask_rows(self.possible_mask)
+
+    def _mask_to_ids(self, mask):
+        ids = []
+        while mask:
+            low = mask & -mask
+            ids.append(self.live_ids[low.bit_length() - 1])
+            mask ^= low
+        return ids
+
     def guess_song(self, song_id, artist_id):
         """
         Returns feedback code:
@@ -95,7 +346,7 @@ class LoveLiveGame:
         if song_id in self.target_live['song_ids_set']:
             # Find artists in this live that are associated with this song
             live_artists = self.target_live['artist_ids_set']
-            song_artists = set(self.songs[song_id]['artist_ids'])
+            song_artists = self.songs[song_id]['artist_ids_set']
 
             # Intersection: Artists in the live who are known to perform this song
             matched = list(live_artists.intersection(song_artists))
@@ -119,65 +370,108 @@ class LoveLiveGame:
 
     def prune_candidates(self, song_id, artist_id, feedback):
         """
-        Updates self.possible_live_ids based on feedback.
+        Updates the candidate bitset (possible_mask) based on feedback.
         Returns remaining count.
         """
-        to_remove = set()
-        for lid in self.possible_live_ids:
-            live = self.lives[lid]
-            has_song = song_id in live['song_ids_set']
-
-            # For artist check, we only check if artist is in live's artist list
-            has_artist = artist_id in live['artist_ids_set']
-
-            if feedback == 0:
-                # Song NOT in live
-                if has_song:
-                    to_remove.add(lid)
-            elif feedback == 1:
-                # Song IN live, Artist NOT in live
-                if not has_song:
-                    to_remove.add(lid)
-                if has_artist:
-                    to_remove.add(lid)
-            elif feedback == 2:
-                # Song IN live, Artist IN live
-                if not has_song:
-                    to_remove.add(lid)
-                if not has_artist:
-                    to_remove.add(lid)
-
-        self.possible_live_ids -= to_remove
-        return len(self.possible_live_ids)
+        has_song = self.song_to_lives_mask.get(song_id, 0)
+        # For artist check, we only check if artist is in live's artist list
+        has_artist = self.artist_to_lives_mask.get(artist_id, 0)
+
+        keep = self.all_lives_mask
+        if feedback == 0:
+            # Song NOT in live
+            keep = ~has_song
+        elif feedback == 1:
+            # Song IN live, Artist NOT in live
+            keep = has_song & ~has_artist
+        elif feedback == 2:
+            # Song IN live, Artist IN live
+            keep = has_song & has_artist
+
+        self._remove_candidates(self.possible_mask & ~keep)
+        return self.candidate_count()
+
+    def prune_song_only(self, song_id, is_correct, matched_artist_ids=()):
+        """
+        Updates the candidates after guess_song_only: a correct guess keeps lives
+        with the song and every matched artist, a wrong one drops lives with it.
+        Returns remaining count.
+        """
+        has_song = self.song_to_lives_mask.get(song_id, 0)
+        if is_correct:
+            keep = has_song
+            for aid in matched_artist_ids:
+                keep &= self.artist_to_lives_mask.get(aid, 0)
+        else:
+            keep = ~has_song
+
+        self._remove_candidates(self.possible_mask & ~keep)
+        return self.candidate_count()
+
+    def remove_candidate(self, live_id):
+        """Rules out a single live, e.g. after a wrong live guess."""
+        if live_id in self.live_index:
+            self._remove_candidates(self.possible_mask & (1 << self.live_index[live_id]))
+
+    def _remove_candidates(self, removed_mask):
+        if not removed_mask:
+            return
+        self.possible_mask &= ~removed_mask
+
+        # Only the removed lives' songs change count
+        rows = self.mask_rows(removed_mask)
+        starts = self.lives_songs_indptr[rows]
+        lengths = self.lives_songs_indptr[rows + 1] - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        self.song_counts -= np.bincount(self.lives_songs[entries], minlength=len(self.song_ids))
+
+        if self.on_candidates_removed is not None:
+            self.on_candidates_removed(rows)
 
     def guess_live(self, live_id):
         self.guessed_live_ids.add(live_id)
         return live_id == self.target_live_id
 
-    def find_song_id(self, name):
-        if name in self.song_name_map:
-            return self.song_name_map[name]
+    def _find_id(self, name, name_map):
+        if name in name_map:
+            return name_map[name]
+
+        folded = self._folded_name_maps.get(id(name_map), {}).get(_fold_name(name))
+        if folded is not None:
+            return folded
+
+        key = (id(name_map), name)
+        if key in self._fuzzy_cache:
+            return self._fuzzy_cache[key]
+
         # Fuzzy search
-        matches = difflib.get_close_matches(name, self.song_name_map.keys(), n=1, cutoff=0.6)
-        if matches:
-            return self.song_name_map[matches[0]]
-        return None
+        if process is not None:
+            choices = self._fuzzy_choices.get(id(name_map))
+            if choices is None:
+                names = list(name_map)
+                choices = (names, [fuzz_utils.default_process(n) for n in names])
+                self._fuzzy_choices[id(name_map)] = choices
+            names, normalized = choices
+            match = process.extractOne(fuzz_utils.default_process(name), normalized,
+                                       scorer=fuzz.ratio, score_cutoff=60, processor=None)
+            result = name_map[names[match[2]]] if match else None
+        else:
+            matches = difflib.get_close_matches(name, name_map.keys(), n=1, cutoff=0.6)
+            result = name_map[matches[0]] if matches else None
+
+        if len(self._fuzzy_cache) >= FUZZY_CACHE_SIZE:
+            self._fuzzy_cache.clear()
+        self._fuzzy_cache[key] = result
+        return result
+
+    def find_song_id(self, name):
+        return self._find_id(name, self.song_name_map)
 
     def find_artist_id(self, name):
-        if name in self.artist_name_map:
-            return self.artist_name_map[name]
-        matches = difflib.get_close_matches(name, self.artist_name_map.keys(), n=1, cutoff=0.6)
-        if matches:
-            return self.artist_name_map[matches[0]]
-        return None
+        return self._find_id(name, self.artist_name_map)
 
     def find_live_id(self, name):
-        if name in self.live_name_map:
-            return self.live_name_map[name]
-        matches = difflib.get_close_matches(name, self.live_name_map.keys(), n=1, cutoff=0.6)
-        if matches:
-            return self.live_name_map[matches[0]]
-        return None
+        return self._find_id(name, self.live_name_map)
 
     def calculate_entropy(self, song_id):
         """
@@ -190,36 +484,26 @@ class LoveLiveGame:
         - Song in live (Yes)
         - Song not in live (No)
         """
-        candidate_count = len(self.possible_live_ids)
+        candidate_count = self.possible_mask.bit_count()
         if candidate_count <= 1:
             return 0.0
 
         # Count how many remaining lives have this song
-        yes_count = 0
-        for lid in self.possible_live_ids:
-            if song_id in self.lives[lid]['song_ids_set']:
-                yes_count += 1
-
-        no_count = candidate_count - yes_count
+        row = self.song_index.get(song_id)
+        yes_count = int(self.song_counts[row]) if row is not None else 0
 
         p_yes = yes_count / candidate_count
-        p_no = no_count / candidate_count
-
-        entropy = 0.0
-        if p_yes > 0:
-            entropy -= p_yes * math.log2(p_yes)
-        if p_no > 0:
-            entropy -= p_no * math.log2(p_no)
-
-        return entropy
+        # p_yes + p_no == 1, so both terms vanish together at 0 and 1
+        if not 0 < p_yes < 1:
+            return 0.0
+        p_no = (candidate_count - yes_count) / candidate_count
+        return -(p_yes * _log2(p_yes) + p_no * _log2(p_no))
 
     def get_best_moves(self, top_k=5):
         """
         Returns list of (song_id, entropy_score)
         sorted by score descending.
         """
-        scores = []
-
         # Optimization: Only consider songs that are present in at least one candidate live?
         # Or consider all songs?
         # Ideally, we want to split the candidate space.
@@ -227,57 +511,83 @@ class LoveLiveGame:
         # A song in ALL candidate lives yields 0 entropy (p_yes=1).
         # So we only need to check songs that appear in the candidate lives.
 
-        relevant_songs = set()
-        for lid in self.possible_live_ids:
-            relevant_songs.update(self.lives[lid]['song_ids_set'])
-
-        for sid in relevant_songs:
-            if sid in self.guessed_song_ids:
-                continue
-
-            score = self.calculate_entropy(sid)
-            scores.append((sid, score))
-
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_k]
+        # Yes-counts are maintained incrementally as candidates are removed
+        candidate_count = self.possible_mask.bit_count()
+        yes_counts = self.song_counts
 
-def play_cli():
-    # Try to load Model for AI Analysis
-    ai_model = None
-    ai_device = None
-    ai_mappings = None
+        relevant = yes_counts > 0
+        relevant[[self.song_index[sid] for sid in self.guessed_song_ids if sid in self.song_index]] = False
+        rows = np.flatnonzero(relevant)
 
+        # Same binary entropy as calculate_entropy, for all relevant songs at once
+        if candidate_count > 1:
+            scores = _entropy_scores(yes_counts, rows, candidate_count)
+        else:
+            scores = np.zeros(len(rows))
+
+        if top_k is not None and 0 < top_k < len(rows):
+            # Only songs scoring at least the k-th best can make the cut
+            kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+            keep = np.flatnonzero(scores >= kth)
+            rows, scores = rows[keep], scores[keep]
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return [(self.song_ids[r], s) for r, s in zip(rows[order].tolist(), scores[order].tolist())]
+
+def _load_cli_ai():
+    """
+    Loads the transformer and its lookup tables for play_cli's analysis mode.
+    Returns a dict of them, or None (after saying why) when torch, the
+    mappings or the weights are unavailable.
+    """
     try:
         import torch
-        from model import LoveLiveTransformer
-
-        # Load mappings
-        try:
-            with open('mappings.json', 'r') as f:
-                ai_mappings = json.load(f)
-
-            # Use mappings for sizing
-            num_songs = len(ai_mappings['song_to_idx']) + 1
-            num_artists = len(ai_mappings['artist_to_idx']) + 1
-            num_feedback = 4
-            num_lives = len(ai_mappings['live_to_idx'])
-
-            if torch.cuda.is_available():
-                ai_device = torch.device('cuda')
-            elif torch.backends.mps.is_available():
-                ai_device = torch.device('mps')
-            else:
-                ai_device = torch.device('cpu')
-
-            ai_model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(ai_device)
-            ai_model.load_state_dict(torch.load('transformer_model.pth', map_location=ai_device))
-            ai_model.eval()
-            print(">> AI Model loaded successfully. Analysis mode will include Model Predictions.")
-        except Exception as e:
-            print(f">> Could not load AI Model ({e}). Analysis mode will be Entropy only.")
-
+        from model import LoveLiveTransformer, lookup_tables, script_for_inference
     except ImportError:
         print(">> Torch not found. Analysis mode will be Entropy only.")
+        return None
+
+    try:
+        with open('mappings.json', 'r') as f:
+            ai_mappings = json.load(f)
+
+        # Use mappings for sizing
+        num_songs = len(ai_mappings['song_to_idx']) + 1
+        num_artists = len(ai_mappings['artist_to_idx']) + 1
+        num_feedback = 4
+        num_lives = len(ai_mappings['live_to_idx'])
+
+        if torch.cuda.is_available():
+            ai_device = torch.device('cuda')
+        elif torch.backends.mps.is_available():
+            ai_device = torch.device('mps')
+        else:
+            ai_device = torch.device('cpu')
+
+        ai_model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(ai_device)
+        ai_model.load_state_dict(torch.load('transformer_model.pth', map_location=ai_device))
+        ai_model.eval()
+        # TorchScript builds in well under a second, unlike torch.compile
+        ai_model = script_for_inference(ai_model, ai_device)
+        print(">> AI Model loaded successfully. Analysis mode will include Model Predictions.")
+    except Exception as e:
+        print(f">> Could not load AI Model ({e}). Analysis mode will be Entropy only.")
+        return None
+
+    return {
+        'model': ai_model,
+        'device': ai_device,
+        **lookup_tables(ai_mappings),
+    }
+
+def play_cli():
+    # torch and the model are only loaded on the first analysis, so a session
+    # that never analyzes starts without them
+    ai = None
+    ai_tried = False
+    # Input buffers reused across analyses; only guesses made since the last
+    # one are written (the history only grows during a game)
+    ai_buffers = None
+    ai_written = 0
 
     game = LoveLiveGame()
     game.start_game()
@@ -300,7 +610,7 @@ def play_cli():
     while True:
         prompt = "\n[S] Guess Song / [L] Guess Live / [A] Analyze / [Q] Quit"
         if pruning_enabled:
-            prompt += f" (Candidates: {len(game.possible_live_ids)})"
+            prompt += f" (Candidates: {game.candidate_count()})"
         prompt += ": "
 
         mode = input(prompt).upper()
@@ -311,38 +621,44 @@ def play_cli():
         elif mode == 'A':
             print("\n=== ANALYSIS ===")
 
+            if not ai_tried:
+                ai = _load_cli_ai()
+                ai_tried = True
+
             # 1. AI Evaluation (Model)
-            if ai_model and game.history:
+            if ai and game.history:
                 try:
-                    song_to_idx = ai_mappings['song_to_idx']
-                    artist_to_idx = ai_mappings['artist_to_idx']
-                    idx_to_live = {v: k for k, v in ai_mappings['live_to_idx'].items()} # Invert map
-
-                    # Prepare input
-                    songs_seq = [song_to_idx[h[0]] + 1 for h in game.history]
-                    artists_seq = [artist_to_idx[h[1]] + 1 for h in game.history]
-                    feedbacks_seq = [h[2] + 1 for h in game.history]
-
-                    s_in = torch.tensor(songs_seq, device=ai_device).unsqueeze(1)
-                    a_in = torch.tensor(artists_seq, device=ai_device).unsqueeze(1)
-                    f_in = torch.tensor(feedbacks_seq, device=ai_device).unsqueeze(1)
-
-                    with torch.no_grad():
-                        logits = ai_model(s_in, a_in, f_in)
-                        probs = torch.softmax(logits, dim=1).squeeze(0)
+                    import torch
+                    from model import SequenceBuffers
+
+                    # Prepare input (seq_len, 1), growing the buffers if the history outgrew them
+                    seq_len = len(game.history)
+                    if ai_buffers is None or seq_len > ai_buffers.max_len:
+                        ai_buffers = SequenceBuffers(max(32, 2 * seq_len), 1, ai['device'])
+                        ai_written = 0
+                    for pos in range(ai_written, seq_len):
+                        sid, aid, fb = game.history[pos]
+                        ai_buffers.write(pos, 0, ai['song_inputs'][sid], ai['artist_inputs'][aid], fb + 1)
+                    ai_written = seq_len
+                    s_in, a_in, f_in = ai_buffers.inputs(seq_len)
+
+                    with torch.inference_mode():
+                        logits = ai['model'](s_in, a_in, f_in)
+                        # Softmax is monotonic: take top-k on the logits and normalize
+                        # only the winners, in FP32, by the log-partition function
+                        logits = logits.float().squeeze(0)
+                        top_logits, top_idxs = torch.topk(logits, k=3)
+                        top_probs = torch.exp(top_logits - torch.logsumexp(logits, dim=0))
 
                     # Top predictions
-                    top_k_pred = torch.topk(probs, k=3)
                     print("\n[AI Position Evaluation]")
-                    for i in range(3):
-                         idx = top_k_pred.indices[i].item()
-                         prob = top_k_pred.values[i].item()
-                         lid = idx_to_live[idx]
+                    for i, (idx, prob) in enumerate(zip(top_idxs.tolist(), top_probs.tolist())):
+                         lid = ai['idx_to_live'][idx]
                          print(f"  {i+1}. {game.lives[lid]['name']} ({prob:.2%})")
 
                 except Exception as e:
                     print(f"Error running AI model: {e}")
-            elif ai_model:
+            elif ai:
                 print("\n[AI Position Evaluation]")
                 print("  (Make at least one guess to get a prediction)")
 
@@ -373,11 +689,7 @@ def play_cli():
 
             if pruning_enabled:
                  # Check validity: Is this song in any remaining candidate live?
-                 is_valid_guess = False
-                 for lid in game.possible_live_ids:
-                     if sid in game.lives[lid]['song_ids_set']:
-                         is_valid_guess = True
-                         break
+                 is_valid_guess = bool(game.possible_mask & game.song_to_lives_mask.get(sid, 0))
 
                  if not is_valid_guess:
                      print("WARNING: This song is not in any of the remaining candidate lives!")
@@ -396,31 +708,15 @@ def play_cli():
 
                     if pruning_enabled:
                          # Prune lives without this song AND without these artists
-                         to_remove = set()
-                         for lid in game.possible_live_ids:
-                             l = game.lives[lid]
-                             if sid not in l['song_ids_set']:
-                                 to_remove.add(lid)
-                             else:
-                                 # Also check artists
-                                 for aid in matched_artists:
-                                     if aid not in l['artist_ids_set']:
-                                         to_remove.add(lid)
-                                         break
-
-                         game.possible_live_ids -= to_remove
-                         print(f"   (Candidates remaining: {len(game.possible_live_ids)})")
+                         rem = game.prune_song_only(sid, True, matched_artists)
+                         print(f"   (Candidates remaining: {rem})")
 
                 else:
                     print(">> WRONG. (Song is not in the live)")
                     if pruning_enabled:
                         # Prune lives WITH this song
-                        to_remove = set()
-                        for lid in game.possible_live_ids:
-                            if sid in game.lives[lid]['song_ids_set']:
-                                to_remove.add(lid)
-                        game.possible_live_ids -= to_remove
-                        print(f"   (Candidates remaining: {len(game.possible_live_ids)})")
+                        rem = game.prune_song_only(sid, False)
+                        print(f"   (Candidates remaining: {rem})")
 
             else:
                 a_name = input("Artist Name: ")
@@ -462,9 +758,8 @@ def play_cli():
             else:
                 print("Incorrect Live.")
                 if pruning_enabled:
-                    if lid in game.possible_live_ids:
-                        game.possible_live_ids.remove(lid)
-                    print(f"   (Candidates remaining: {len(game.possible_live_ids)})")
+                    game.remove_candidate(lid)
+                    print(f"   (Candidates remaining: {game.candidate_count()})")
 
 if __name__ == "__main__":
     play_cli()
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import inspect
 import math
 
 class PositionalEncoding(nn.Module):
@@ -64,11 +65,212 @@ class LoveLiveTransformer(nn.Module):
         count_valid = torch.sum(mask, dim=1)
 
         # Avoid division by zero
-        count_valid = torch.clamp(count_valid, min=1.0)
+        count_valid = count_valid.clamp_(min=1.0)
 
-        # Mean
-        pooled_output = sum_output / count_valid
+        # Mean (both operands are fresh reductions, so divide in place)
+        pooled_output = sum_output.div_(count_valid)
 
         # Classification
         logits = self.fc_out(pooled_output)
         return logits
+
+class SequenceBuffers:
+    """
+    Preallocated (max_len, batch_size) buffers for the song/artist/feedback model inputs.
+    Tokens are written in place into a host staging area (pinned when on CUDA) and
+    copied to the device in one non-blocking transfer per forward, instead of
+    building three new tensors from Python lists every turn.
+    """
+    def __init__(self, max_len, batch_size, device):
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.device = device
+        self.host = torch.zeros(3, max_len, batch_size, dtype=torch.long, pin_memory=(device.type == 'cuda'))
+        if device.type == 'cpu':
+            self.dev = self.host
+        else:
+            self.dev = torch.zeros(3, max_len, batch_size, dtype=torch.long, device=device)
+        self._host_np = self.host.numpy()
+
+    def reset(self):
+        self.host.zero_()
+        if self.dev is not self.host:
+            self.dev.zero_()
+
+    def write(self, pos, col, song, artist, feedback):
+        # Values are model inputs, i.e. already offset by +1 (0 is padding)
+        self._host_np[:, pos, col] = (song, artist, feedback)
+
+    def write_sequence(self, col, tokens):
+        """Writes a whole (song, artist, feedback) input sequence into column col in one assignment."""
+        if tokens:
+            self._host_np[:, :len(tokens), col] = list(zip(*tokens))
+
+    def inputs(self, length, cols=None):
+        """
+        Returns (song, artist, feedback) tensors of shape (length, batch) on the device.
+        cols optionally selects a subset of batch columns (a LongTensor on the device).
+        """
+        if self.dev is not self.host:
+            self.dev[:, :length].copy_(self.host[:, :length], non_blocking=True)
+        seqs = self.dev[:, :length]
+        if cols is not None:
+            seqs = seqs.index_select(2, cols)
+        return seqs[0], seqs[1], seqs[2]
+
+def lookup_tables(mappings):
+    """
+    Builds the lookup tables inference needs from a mappings.json dict:
+    song_inputs / artist_inputs, id -> model input token (index + 1, 0 is
+    padding), and idx_to_live, the inverse of live_to_idx as a list (indices
+    are dense, 0..n-1).
+    """
+    live_to_idx = mappings['live_to_idx']
+    return {
+        'song_inputs': {sid: i + 1 for sid, i in mappings['song_to_idx'].items()},
+        'artist_inputs': {aid: i + 1 for aid, i in mappings['artist_to_idx'].items()},
+        'idx_to_live': sorted(live_to_idx, key=live_to_idx.get),
+    }
+
+def load_weights(model, path, device):
+    """
+    Loads a saved state dict into model. Where torch.load supports it (>= 2.1),
+    the checkpoint is memory-mapped so pages are only read when touched,
+    unpickling is restricted to tensors (weights_only), and the loaded tensors
+    are assigned to the module directly instead of copied into fresh ones.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        state = torch.load(path, map_location=device, mmap=True, weights_only=True)
+        model.load_state_dict(state, assign=True)
+    else:
+        model.load_state_dict(torch.load(path, map_location=device))
+    return model
+
+def configure_cpu_threads():
+    """
+    Uses a single inter-op thread, which avoids oversubscription for
+    batch-size-1 inference on CPU. The intra-op count is left at torch's
+    default, which already respects the CPU affinity mask and SMT.
+    """
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+
+def _warmup(model, device, warmup_shapes):
+    # Inputs are built like SequenceBuffers.inputs(): three distinct slices of
+    # one normal (non-inference) long tensor, so the compiled code's guards on
+    # identity and dispatch keys hold for the real calls afterwards
+    for seq_len, batch_size in warmup_shapes:
+        buffers = SequenceBuffers(seq_len, batch_size, device)
+        buffers.host.fill_(1)
+        with torch.inference_mode():
+            model(*buffers.inputs(seq_len))
+
+def compile_tensorrt(model, device, seq_len, batch_size=1):
+    """
+    Compiles model into a Torch-TensorRT FP16 engine for fixed-shape inputs
+    (callers pad sequences up to seq_len). Returns None when torch_tensorrt is
+    not installed or the engine fails to build, so callers can fall back.
+    """
+    try:
+        import torch_tensorrt  # noqa: F401 (registers the "torch_tensorrt" backend)
+    except ImportError:
+        return None
+
+    try:
+        compiled = torch.compile(model, backend="torch_tensorrt", dynamic=False, options={
+            "enabled_precisions": {torch.float16},
+            "min_block_size": 3,
+            "workspace_size": 1 << 30,
+        })
+        _warmup(compiled, device, [(seq_len, batch_size)])
+        return compiled
+    except Exception as e:
+        print(f"TensorRT compilation failed ({e}).")
+        return None
+
+class CUDAGraphModel:
+    """
+    Replays one captured CUDA graph per sequence length 1..max_len for a fixed
+    batch size. Inputs are copied into static buffers before each replay and
+    the returned logits tensor is overwritten by the next call.
+    """
+    def __init__(self, model, device, max_len, batch_size=1):
+        self.static_inputs = torch.zeros(3, max_len, batch_size, dtype=torch.long, device=device)
+        self.static_inputs[:, 0] = 1
+        self.graphs = {}
+        self.outputs = {}
+
+        # Warm up on a side stream before capturing, as CUDA graphs require
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.inference_mode(), torch.cuda.stream(stream):
+            for _ in range(3):
+                model(*self.static_inputs[:, :max_len])
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        pool = torch.cuda.graph_pool_handle()
+        with torch.inference_mode():
+            for length in range(1, max_len + 1):
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph, pool=pool):
+                    self.outputs[length] = model(*self.static_inputs[:, :length])
+                self.graphs[length] = graph
+
+    def __call__(self, song_seq, artist_seq, feedback_seq):
+        length = song_seq.size(0)
+        static = self.static_inputs[:, :length]
+        static[0].copy_(song_seq, non_blocking=True)
+        static[1].copy_(artist_seq, non_blocking=True)
+        static[2].copy_(feedback_seq, non_blocking=True)
+        self.graphs[length].replay()
+        return self.outputs[length]
+
+def capture_cuda_graphs(model, device, max_len, batch_size=1):
+    """
+    Captures model as a CUDAGraphModel. Returns None off CUDA or when capture
+    fails, so callers can fall back to compile_for_inference.
+    """
+    if device.type != 'cuda':
+        return None
+    try:
+        return CUDAGraphModel(model, device, max_len, batch_size)
+    except Exception as e:
+        print(f"CUDA graph capture failed ({e}).")
+        return None
+
+def compile_for_inference(model, device, warmup_shapes=((1, 1), (2, 1)), mode="reduce-overhead", dynamic=True):
+    """
+    Compiles an eval-mode model with torch.compile and warms it up on the given
+    (seq_len, batch_size) input shapes, so compilation is paid at load time
+    instead of on the first real call. The compiler specializes dimensions of
+    size 1, hence the default warmup on both a length-1 and a longer sequence.
+    If torch.compile is unavailable (e.g. no C++ toolchain for inductor), falls
+    back to a frozen TorchScript module run through optimize_for_inference,
+    and finally to the eager model.
+    """
+    try:
+        compiled = torch.compile(model, mode=mode, fullgraph=True, dynamic=dynamic)
+        _warmup(compiled, device, warmup_shapes)
+        return compiled
+    except Exception as e:
+        print(f"torch.compile failed ({e}). Trying TorchScript.")
+
+    return script_for_inference(model, device, warmup_shapes)
+
+def script_for_inference(model, device, warmup_shapes=((1, 1), (2, 1))):
+    """
+    Freezes an eval-mode model into a TorchScript module run through
+    optimize_for_inference, warmed up on the given (seq_len, batch_size)
+    shapes. Much cheaper to build than torch.compile, so it suits short
+    sessions such as the CLI. Falls back to the eager model on failure.
+    """
+    try:
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(model.eval())))
+        _warmup(scripted, device, warmup_shapes)
+        return scripted
+    except Exception as e:
+        print(f"TorchScript optimization failed ({e}). Using eager model.")
+        return model
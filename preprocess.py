@@ -1,17 +1,45 @@
 import json
 import os
-
-def load_json(filepath):
-    with open(filepath, 'r', encoding='utf-8') as f:
-        return json.load(f)
+# game's optional orjson import (None when not installed) also serves save_json
+from game import build_index_arrays, load_game_data, orjson, save_index_arrays
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def iter_json_items(filepath):
+    """
+    Iterates the (key, value) pairs of a top-level JSON object. With ijson the
+    file is stream-parsed, so only one entry is held in memory at a time. The
+    file is opened here, so a missing file raises immediately.
+    """
+    if ijson is None:
+        return iter(load_game_data(filepath).items())
+
+    f = open(filepath, 'rb')
+    def items():
+        with f:
+            yield from ijson.kvitems(f, '', use_float=True)
+    return items()
+
+def save_json(data, filepath):
+    if orjson is not None:
+        # orjson writes UTF-8 as-is, like ensure_ascii=False
+        with open(filepath, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
 
 def preprocess():
     print("Loading data...")
     try:
-        songs = load_json('data/song-info.json')
-        artists = load_json('data/artists-info.json')
-        lives_info = load_json('data/performance-info.json')
-        setlists = load_json('data/performance-setlists.json')
+        songs = load_game_data('data/song-info.json')
+        artists = load_game_data('data/artists-info.json')
+        lives_info = load_game_data('data/performance-info.json')
+        # By far the largest input, so it is streamed rather than loaded whole
+        setlists = iter_json_items('data/performance-setlists.json')
     except FileNotFoundError as e:
         print(f"Error loading files: {e}")
         return
@@ -42,7 +70,7 @@ def preprocess():
     # Filter lives that have setlist
     valid_lives_info = {l['id']: l for l in lives_info if l.get('hasSetlist')}
 
-    for live_id, setlist_data in setlists.items():
+    for live_id, setlist_data in setlists:
         if live_id not in valid_lives_info:
             continue
 
@@ -72,11 +100,7 @@ def preprocess():
         # Or better: "Is the artist of the guessed song one of the performers in the live?"
 
         # Let's aggregate all artist IDs from all songs in the live.
-        live_artist_ids = set()
-        for sid in live_song_ids:
-            if sid in song_map:
-                for aid in song_map[sid]['artist_ids']:
-                    live_artist_ids.add(aid)
+        live_artist_ids = set().union(*(song_map[sid]['artist_ids'] for sid in live_song_ids if sid in song_map))
 
         processed_lives[live_id] = {
             'name': live_name,
@@ -92,9 +116,11 @@ def preprocess():
         'lives': processed_lives
     }
 
-    with open('game_data.json', 'w', encoding='utf-8') as f:
-        json.dump(game_data, f, ensure_ascii=False, indent=2)
+    save_json(game_data, 'game_data.json')
     print("Saved to game_data.json")
 
+    save_index_arrays(build_index_arrays(game_data))
+    print("Saved lookup tables to game_index/")
+
 if __name__ == "__main__":
     preprocess()
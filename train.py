@@ -3,113 +3,180 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
-import random
 import numpy as np
 from tqdm import tqdm
 from model import LoveLiveTransformer
 from game import LoveLiveGame
 
 class GameDataset(Dataset):
-    def __init__(self, game, song_to_idx, artist_to_idx, live_to_idx, num_samples=10000, max_seq_len=20):
+    def __init__(self, game, song_to_idx, artist_to_idx, live_to_idx, num_samples=10000, max_seq_len=20, seed=None):
         self.game = game
         self.song_to_idx = song_to_idx
         self.artist_to_idx = artist_to_idx
         self.live_to_idx = live_to_idx
         self.num_samples = num_samples
         self.max_seq_len = max_seq_len
-        self.data = []
-
-        self.all_song_ids = list(game.songs.keys())
-        self.all_artist_ids = list(game.artists.keys())
+        self.rng = np.random.default_rng(seed)
+
+        # Samples are drawn over game row numbers (positions in song_ids /
+        # artist_ids / live_ids) and mapped to model indices by lookup arrays
+        self.song_idx = np.array([song_to_idx[sid] for sid in game.song_ids], dtype=np.int64)
+        self.artist_idx = np.array([artist_to_idx[aid] for aid in game.artist_ids], dtype=np.int64)
+        self.live_idx = np.array([live_to_idx[lid] for lid in game.live_ids], dtype=np.int64)
+        self.songs_artists = np.asarray(game.songs_artists, dtype=np.int64)
+        self.songs_artists_indptr = np.asarray(game.songs_artists_indptr, dtype=np.int64)
+
+        # Songs of each live as a padded (num_lives, max_songs) table, and dense
+        # live x song / live x artist membership for the feedback
+        lives_songs_indptr = np.asarray(game.lives_songs_indptr, dtype=np.int64)
+        self.live_song_counts = np.diff(lives_songs_indptr)
+        live_rows = np.repeat(np.arange(len(game.live_ids)), self.live_song_counts)
+        slots = np.arange(len(live_rows)) - lives_songs_indptr[live_rows]
+        self.live_song_table = np.zeros((len(game.live_ids), max(1, self.live_song_counts.max(initial=0))), dtype=np.int64)
+        self.live_song_table[live_rows, slots] = game.lives_songs
+        self.live_has_song = np.zeros((len(game.live_ids), len(game.song_ids)), dtype=bool)
+        self.live_has_song[live_rows, game.lives_songs] = True
+        artist_rows = {aid: i for i, aid in enumerate(game.artist_ids)}
+        self.live_has_artist = np.zeros((len(game.live_ids), len(game.artist_ids)), dtype=bool)
+        for r, lid in enumerate(game.live_ids):
+            self.live_has_artist[r, [artist_rows[aid] for aid in game.lives[lid]['artist_ids_set'] if aid in artist_rows]] = True
 
         print(f"Pre-generating {num_samples} samples...")
-        for _ in tqdm(range(num_samples)):
-            self.data.append(self.generate_sample())
-
-    def generate_sample(self):
-        # 1. Pick a target live
-        target_live_id = random.choice(self.game.live_ids)
-        target_live = self.game.lives[target_live_id]
-
-        # Set target live for feedback generation
-        self.game.target_live_id = target_live_id
-        self.game.target_live = target_live
-
-        target_songs = target_live['song_ids']
-
-        # 2. Generate guess sequence
-        seq_len = random.randint(1, self.max_seq_len)
-
-        songs_seq = []
-        artists_seq = []
-        feedbacks_seq = []
-
-        used_song_ids = set()
-
-        for _ in range(seq_len):
-            # Strategy: Mix of correct and incorrect guesses
-            # Try to pick a song we haven't guessed yet
-
-            # Determine if we try to guess a correct song or random song
-            guess_correct = (target_songs and random.random() < 0.3)
-
-            guessed_song_id = None
-            guessed_artist_id = None
-
-            if guess_correct:
-                # Pick a song actually in the live (that hasn't been used)
-                valid_targets = [s for s in target_songs if s not in used_song_ids]
-                if valid_targets:
-                    guessed_song_id = random.choice(valid_targets)
-                    # Pick correct artist or incorrect artist
-                    song_artist_ids = self.game.songs[guessed_song_id]['artist_ids']
-                    if song_artist_ids and random.random() < 0.8:
-                         guessed_artist_id = random.choice(song_artist_ids)
-                    else:
-                         guessed_artist_id = random.choice(self.all_artist_ids)
-
-            if guessed_song_id is None:
-                # Random guess (retry a few times to find unused)
-                for _ in range(10):
-                    candidate = random.choice(self.all_song_ids)
-                    if candidate not in used_song_ids:
-                        guessed_song_id = candidate
-                        break
-
-                if guessed_song_id is None:
-                    # If we really can't find a new song (unlikely), just pick any
-                    guessed_song_id = random.choice(self.all_song_ids)
-
-                guessed_artist_id = random.choice(self.all_artist_ids)
-
-            used_song_ids.add(guessed_song_id)
-            feedback = self.game.guess_song(guessed_song_id, guessed_artist_id)
-
-            # Map to indices
-            songs_seq.append(self.song_to_idx[guessed_song_id])
-            artists_seq.append(self.artist_to_idx[guessed_artist_id])
-            feedbacks_seq.append(feedback) # 0, 1, 2
-
-        # Pad to max_seq_len
-        padded_songs = np.zeros(self.max_seq_len, dtype=int)
-        padded_artists = np.zeros(self.max_seq_len, dtype=int)
-        padded_feedbacks = np.zeros(self.max_seq_len, dtype=int)
-
-        length = len(songs_seq)
-        padded_songs[:length] = [s + 1 for s in songs_seq]
-        padded_artists[:length] = [a + 1 for a in artists_seq]
-        padded_feedbacks[:length] = [f + 1 for f in feedbacks_seq] # 0->1, 1->2, 2->3
-
-        return (torch.tensor(padded_songs),
-                torch.tensor(padded_artists),
-                torch.tensor(padded_feedbacks),
-                torch.tensor(self.live_to_idx[target_live_id]))
+        # All samples live in two preallocated tensors; items are views into them
+        self.inputs, self.targets = self.generate_samples(num_samples)
+
+    def _redraw_repeats(self, songs, free, valid):
+        """
+        Rejection sampling: redraws the free positions of every row whose valid
+        songs contain a repeat, until no row does.
+        """
+        num_songs = len(self.song_idx)
+        if self.max_seq_len > num_songs:
+            # Not enough songs to keep every position distinct
+            return
+        padding = -1 - np.arange(self.max_seq_len) # distinct, never equal to a song row
+        rows = np.arange(len(songs))
+        while len(rows):
+            ordered = np.sort(np.where(valid[rows], songs[rows], padding), axis=1)
+            rows = rows[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+            redraw = songs[rows]
+            redraw[free[rows]] = self.rng.integers(num_songs, size=int(free[rows].sum()))
+            songs[rows] = redraw
+
+    def generate_samples(self, n):
+        """
+        Generates n samples at once. Returns the (3, max_seq_len, n) song /
+        artist / feedback inputs, offset by +1 and right-padded with 0 and laid
+        out sequence-major like the model's (seq_len, batch) input, and the
+        (n,) target live indices, both as int32 tensors (half the bytes of
+        int64 to hold and move; embeddings accept int32 indices).
+        """
+        rng = self.rng
+        max_len = self.max_seq_len
+
+        # 1. Pick target lives and sequence lengths
+        targets = rng.integers(len(self.live_idx), size=n)
+        lengths = rng.integers(1, max_len + 1, size=n)
+        valid = np.arange(max_len) < lengths[:, None]
+
+        # 2. Generate guess sequences. Strategy: Mix of correct and incorrect
+        # guesses. Each guess tries a song from the live with probability 0.3;
+        # once the live's songs run out, the remaining tries become random
+        # guesses. Random songs are distinct, as are the songs taken from the live.
+        songs = rng.integers(len(self.song_idx), size=(n, max_len))
+        tries = valid & (rng.random((n, max_len)) < 0.3)
+        rank = np.cumsum(tries, axis=1) - 1
+        correct = tries & (rank < self.live_song_counts[targets][:, None])
+
+        # The k-th correct guess of a sample takes the k-th song of a random
+        # permutation of its live's songs (padding slots sort last)
+        keys = rng.random((n, self.live_song_table.shape[1]))
+        keys[np.arange(keys.shape[1]) >= self.live_song_counts[targets][:, None]] = 2.0
+        order = np.argsort(keys, axis=1)
+        rows, cols = np.nonzero(correct)
+        songs[rows, cols] = self.live_song_table[targets[rows], order[rows, rank[rows, cols]]]
+        self._redraw_repeats(songs, valid & ~correct, valid)
+
+        # Random artists, except that correct songs get one of their own
+        # artists (if they have any) 80% of the time
+        artists = rng.integers(len(self.artist_idx), size=(n, max_len))
+        first = self.songs_artists_indptr[songs[rows, cols]]
+        count = self.songs_artists_indptr[songs[rows, cols] + 1] - first
+        own = (count > 0) & (rng.random(len(rows)) < 0.8)
+        picks = first + (rng.random(len(rows)) * count).astype(np.int64)
+        artists[rows[own], cols[own]] = self.songs_artists[picks[own]]
+
+        # Feedback as in LoveLiveGame.guess_song: 0 song not in live,
+        # 1 song in live but artist not, 2 both in live
+        has_song = self.live_has_song[targets[:, None], songs]
+        has_artist = self.live_has_artist[targets[:, None], artists]
+        feedbacks = has_song * (1 + has_artist)
+
+        # Map to indices; 0 is padding, so feedback 0->1, 1->2, 2->3
+        inputs = np.stack((self.song_idx[songs], self.artist_idx[artists], feedbacks)).astype(np.int32) + 1
+        inputs[:, ~valid] = 0
+        inputs = np.ascontiguousarray(inputs.transpose(0, 2, 1))
+
+        return torch.from_numpy(inputs), torch.from_numpy(self.live_idx[targets].astype(np.int32))
+
+    def __getstate__(self):
+        # What DataLoader workers get under the spawn start method: only the
+        # generated samples, not the game or the generation tables
+        return {'num_samples': self.num_samples, 'max_seq_len': self.max_seq_len,
+                'inputs': self.inputs, 'targets': self.targets}
 
     def __len__(self):
         return self.num_samples
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        return self.inputs[0, :, idx], self.inputs[1, :, idx], self.inputs[2, :, idx], self.targets[idx]
+
+    def __getitems__(self, indices):
+        # Whole-batch fetch (used by the DataLoader on torch >= 2.0): one gather
+        # per tensor instead of stacking batch_size single samples. Inputs come
+        # out as contiguous (seq_len, batch_size) tensors, ready for the model.
+        idx = torch.as_tensor(indices)
+        return tuple(self.inputs[:, :, idx]) + (self.targets[idx],)
+
+def collate_batch(batch):
+    """
+    Passes through batches gathered by GameDataset.__getitems__; otherwise
+    stacks per-sample items into the same (seq_len, batch_size) inputs.
+    """
+    if isinstance(batch, tuple):
+        return batch
+    songs, artists, feedbacks, targets = zip(*batch)
+    return (torch.stack(songs, dim=1), torch.stack(artists, dim=1), torch.stack(feedbacks, dim=1),
+            torch.stack(targets))
+
+def prefetch_to_device(loader, device):
+    """
+    Yields loader's batches moved to device. On CUDA the copy of the next
+    batch is issued on a side stream while the current one is being trained on.
+    """
+    if device.type != 'cuda':
+        for batch in loader:
+            yield tuple(t.to(device) for t in batch)
+        return
+
+    stream = torch.cuda.Stream()
+
+    def load(batch):
+        with torch.cuda.stream(stream):
+            return tuple(t.to(device, non_blocking=True) for t in batch)
+
+    it = iter(loader)
+    pending = next(it, None)
+    pending = load(pending) if pending is not None else None
+    while pending is not None:
+        torch.cuda.current_stream().wait_stream(stream)
+        # Allocated on the side stream but consumed on the current one
+        for t in pending:
+            t.record_stream(torch.cuda.current_stream())
+        batch = pending
+        upcoming = next(it, None)
+        pending = load(upcoming) if upcoming is not None else None
+        yield batch
 
 def train(args):
     game = LoveLiveGame()
@@ -119,22 +186,30 @@ def train(args):
     artist_to_idx = {aid: i for i, aid in enumerate(game.artist_ids)}
     live_to_idx = {lid: i for i, lid in enumerate(game.live_ids)}
 
-    # Save mappings
-    with open('mappings.json', 'w') as f:
-        json.dump({
-            'song_to_idx': song_to_idx,
-            'artist_to_idx': artist_to_idx,
-            'live_to_idx': live_to_idx
-        }, f)
-
-    dataset = GameDataset(game, song_to_idx, artist_to_idx, live_to_idx, num_samples=args.num_samples)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-
-    # +1 for padding
-    num_songs = len(game.songs) + 1
-    num_artists = len(game.artists) + 1
-    num_feedback = 4 # 0(pad), 1(0), 2(1), 3(2)
-    num_lives = len(game.lives)
+    # Save mappings, leaving the file alone when it already holds the same ones
+    mappings = json.dumps({
+        'song_to_idx': song_to_idx,
+        'artist_to_idx': artist_to_idx,
+        'live_to_idx': live_to_idx
+    })
+    try:
+        with open('mappings.json') as f:
+            unchanged = f.read() == mappings
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        with open('mappings.json', 'w') as f:
+            f.write(mappings)
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+
+    dataset = GameDataset(game, song_to_idx, artist_to_idx, live_to_idx, num_samples=args.num_samples, seed=args.seed)
+    if args.num_workers > 0:
+        # With __getstate__ trimming the dataset to its samples, spawned
+        # workers receive handles to these two tensors and nothing else
+        dataset.inputs.share_memory_()
+        dataset.targets.share_memory_()
 
     if torch.cuda.is_available():
         device = torch.device('cuda')
@@ -143,30 +218,60 @@ def train(args):
     else:
         device = torch.device('cpu')
     print(f"Using device: {device}")
+    compile_model = device.type == 'cuda' and not args.no_compile
+
+    # Pinned batches allow async host-to-device copies; workers, if any, are
+    # kept alive between epochs
+    worker_options = {'persistent_workers': True, 'prefetch_factor': 2} if args.num_workers > 0 else {}
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
+                            collate_fn=collate_batch, pin_memory=(device.type == 'cuda'),
+                            drop_last=compile_model, **worker_options)
+
+    # +1 for padding
+    num_songs = len(game.songs) + 1
+    num_artists = len(game.artists) + 1
+    num_feedback = 4 # 0(pad), 1(0), 2(1), 3(2)
+    num_lives = len(game.lives)
 
     model = LoveLiveTransformer(num_songs, num_artists, num_feedback, num_lives).to(device)
+    # With drop_last every batch has the same (max_seq_len, batch_size) shape, so
+    # one compiled, CUDA-graphed step is reused throughout. The wrapper shares
+    # the parameters of model, which is what gets saved.
+    train_model = torch.compile(model, mode='reduce-overhead') if compile_model else model
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=0.001)
 
+    # Mixed precision on CUDA: bfloat16 where supported (no loss scaling
+    # needed), otherwise float16 with a GradScaler
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=(use_amp and amp_dtype == torch.float16))
+
     epochs = args.epochs
     for epoch in range(epochs):
         model.train()
-        total_loss = 0
-        for song_seq, artist_seq, fb_seq, target in tqdm(dataloader, desc=f"Epoch {epoch+1}"):
-            song_seq, artist_seq, fb_seq, target = song_seq.to(device), artist_seq.to(device), fb_seq.to(device), target.to(device)
+        # Summed on the device so each batch doesn't force a host sync
+        total_loss = torch.zeros((), device=device)
+        batches = prefetch_to_device(dataloader, device)
+        for song_seq, artist_seq, fb_seq, target in tqdm(batches, total=len(dataloader), desc=f"Epoch {epoch+1}"):
+            # CrossEntropyLoss wants int64 class indices; widen on the device
+            target = target.long()
 
-            # Input to model: (seq_len, batch_size)
-            output = model(song_seq.T, artist_seq.T, fb_seq.T)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                # Input to model: (seq_len, batch_size), as the dataset lays it out
+                output = train_model(song_seq, artist_seq, fb_seq)
 
-            loss = criterion(output, target)
+                loss = criterion(output, target)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            # Plain backward/step when the scaler is disabled
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            total_loss += loss.item()
+            total_loss += loss.detach()
 
-        print(f"Epoch {epoch+1} Loss: {total_loss / len(dataloader)}")
+        print(f"Epoch {epoch+1} Loss: {(total_loss / len(dataloader)).item()}")
 
     torch.save(model.state_dict(), 'transformer_model.pth')
     print("Model saved.")
@@ -184,6 +289,8 @@ if __name__ == "__main__":
     parser.add_argument('--num_workers', type=int, default=0, help='Number of workers for data loading (set >0 for threading)')
     parser.add_argument('--epochs', type=int, default=10, help='Number of epochs to train')
     parser.add_argument('--num_samples', type=int, default=10000, help='Number of samples to pre-generate')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for reproducible sample generation and training')
+    parser.add_argument('--no_compile', action='store_true', help='Train the eager model on CUDA instead of a torch.compile one')
 
     args = parser.parse_args()
 